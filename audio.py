@@ -0,0 +1,429 @@
+"""
+Audio buffering and decoding shared by the streaming endpoints.
+"""
+import asyncio
+import collections
+import io
+import logging
+import threading
+
+import av
+import numpy as np
+
+PCM16_SCALE = 1.0 / 32768.0
+
+log = logging.getLogger(__name__)
+
+
+class VoiceActivityDetector:
+    """Frame-level energy VAD with an adaptive noise floor and endpointing.
+
+    Cheap enough to run on every incoming frame: energies are computed for all
+    complete 30 ms frames in one vectorised pass, then a small state machine
+    tracks speech onset (``speech_ms`` of consecutive speech frames) and end of
+    utterance (``silence_ms`` of consecutive non-speech frames). Positions are
+    absolute sample indices, matching AudioRingBuffer.
+
+    The noise floor is the minimum frame energy over the last ``noise_ms``
+    (minimum statistics): gaps between words pull it down, and steady noise
+    of any level becomes the floor within one window.
+    """
+
+    def __init__(self, sample_rate: int = 16000, frame_ms: int = 30, threshold_db: float = 10.0,
+                 min_level_db: float = -50.0, speech_ms: int = 90, silence_ms: int = 600, noise_ms: int = 1000):
+        self.frame = int(sample_rate * frame_ms / 1000)
+        self.threshold_db = threshold_db
+        self.min_level_db = min_level_db
+        self.speech_frames = max(1, speech_ms // frame_ms)
+        self.silence_frames = max(1, silence_ms // frame_ms)
+        self.noise_floor_db = min_level_db
+        self._recent_db = collections.deque(maxlen=max(1, noise_ms // frame_ms))
+        self.in_speech = False
+        self.utterance_start = 0       # start of the current (or last) utterance
+        self.last_speech_end = 0       # end of the last speech frame seen
+        self.speech_samples = 0
+        self._run = 0                  # consecutive frames contradicting the current state
+        self._run_start = 0
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._pending_start = 0
+        self._endpoints = []
+
+    def process(self, samples: np.ndarray, start_index: int):
+        if len(self._pending):
+            samples = np.concatenate([self._pending, samples])
+            start_index = self._pending_start
+        n_frames = len(samples) // self.frame
+        used = n_frames * self.frame
+        self._pending = samples[used:].copy()
+        self._pending_start = start_index + used
+        if n_frames == 0:
+            return
+
+        frames = samples[:used].reshape(n_frames, self.frame)
+        energy_db = 10.0 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+        for i, db in enumerate(energy_db):
+            self._step(float(db), start_index + i * self.frame)
+
+    def _step(self, db: float, pos: int):
+        self._recent_db.append(db)
+        self.noise_floor_db = min(self._recent_db)
+        if len(self._recent_db) < self._recent_db.maxlen:
+            # Until a full window has been seen, don't let a session that opens mid-speech set the floor
+            self.noise_floor_db = min(self.noise_floor_db, self.min_level_db)
+        is_speech = db > max(self.noise_floor_db + self.threshold_db, self.min_level_db)
+
+        if is_speech:
+            self.last_speech_end = pos + self.frame
+            self.speech_samples += self.frame
+
+        if is_speech != self.in_speech:
+            if self._run == 0:
+                self._run_start = pos
+            self._run += 1
+        else:
+            self._run = 0
+
+        if not self.in_speech and self._run >= self.speech_frames:
+            self.in_speech = True
+            self.utterance_start = self._run_start
+            self._run = 0
+        elif self.in_speech and self._run >= self.silence_frames:
+            self.in_speech = False
+            self._endpoints.append((self.utterance_start, self.last_speech_end))
+            self._run = 0
+
+    def speech_since(self, index: int) -> bool:
+        """True if speech is ongoing or any speech frame ended after index."""
+        return self.in_speech or self.last_speech_end > index
+
+    def pop_endpoints(self) -> list:
+        """Utterances (start, end) that have ended since the last call."""
+        endpoints, self._endpoints = self._endpoints, []
+        return endpoints
+
+
+class AudioRingBuffer:
+    """Fixed-capacity float32 audio buffer with absolute sample indexing.
+
+    Samples live contiguously in a preallocated array twice the capacity.
+    When the write position reaches the end, the retained tail is copied into
+    a fresh array, so appends are amortised O(1) and windows are always
+    contiguous views. Old views are never overwritten, which makes them safe
+    to hand to a decode running on another thread.
+
+    Absolute indices count samples since the buffer was created; only the
+    most recent ``capacity`` samples are addressable. An optional
+    VoiceActivityDetector sees every sample as it is appended.
+    """
+
+    def __init__(self, max_seconds: float, sample_rate: int = 16000, vad: VoiceActivityDetector = None):
+        self.sample_rate = sample_rate
+        self.vad = vad
+        self.capacity = max(1, int(max_seconds * sample_rate))
+        self._buf = np.zeros(2 * self.capacity, dtype=np.float32)
+        self._end = 0                  # write position in _buf
+        self._base = 0                 # absolute index of _buf[0]; _base + _end == total_samples_received
+        self._floor = 0                # samples before this absolute index have been discarded
+        self.total_samples_received = 0
+
+    def __len__(self) -> int:
+        return max(0, min(self._end, self.capacity, self.total_samples_received - self._floor))
+
+    @property
+    def start_index(self) -> int:
+        """Absolute index of the oldest addressable sample."""
+        return self.total_samples_received - len(self)
+
+    @property
+    def end_index(self) -> int:
+        """Absolute index one past the newest sample."""
+        return self.total_samples_received
+
+    def extend_pcm16(self, pcm: bytes):
+        # Expect 16-bit mono little-endian PCM at sample_rate
+        self.extend(np.frombuffer(pcm, dtype="<i2"), PCM16_SCALE)
+
+    def extend(self, samples: np.ndarray, scale: float = 1.0):
+        n = len(samples)
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest `capacity` samples can ever be read back
+            self._base += self._end + n - self.capacity
+            self._end = 0
+            # Fresh array: views of the old one may still be in use by decodes on other threads
+            self._buf = np.empty_like(self._buf)
+            self.total_samples_received += n - self.capacity
+            samples = samples[-self.capacity:]
+            n = self.capacity
+        if self._end + n > len(self._buf):
+            keep = min(self.capacity - n, self._end)
+            buf = np.empty_like(self._buf)
+            buf[:keep] = self._buf[self._end - keep:self._end]
+            self._base += self._end - keep
+            self._end = keep
+            self._buf = buf
+        out = self._buf[self._end:self._end + n]
+        if scale == 1.0:
+            out[:] = samples
+        else:
+            np.multiply(samples, scale, out=out, casting="unsafe")
+        self._end += n
+        self.total_samples_received += n
+        if self.vad is not None:
+            self.vad.process(out, self.total_samples_received - n)
+
+    def discard_before(self, index: int):
+        """Drop samples before absolute index so they are no longer addressable."""
+        self._floor = max(self._floor, min(index, self.end_index))
+
+    def get_range(self, start: int, end: int = None) -> np.ndarray:
+        """Contiguous float32 view of absolute samples [start, end), clipped to what is retained."""
+        if end is None:
+            end = self.end_index
+        start = max(start, self.start_index)
+        end = min(end, self.end_index)
+        if end <= start:
+            return self._buf[:0]
+        return self._buf[start - self._base:end - self._base]
+
+    def get_window(self, window_sec: float) -> np.ndarray:
+        """Contiguous float32 view of the most recent window_sec seconds (or less)."""
+        win = int(window_sec * self.sample_rate)
+        return self.get_range(self.end_index - win)
+
+
+def decode_audio_file(fileobj, sample_rate: int = 16000) -> np.ndarray:
+    """Decode any container/codec av understands to float32 mono at sample_rate, in memory."""
+    resampler = av.audio.resampler.AudioResampler(format='flt', layout='mono', rate=sample_rate)
+    chunks = []
+    with av.open(fileobj, mode='r') as container:
+        if not container.streams.audio:
+            raise ValueError("no audio stream in input")
+        stream = container.streams.audio[0]
+        for frame in container.decode(stream):
+            chunks.extend(f.to_ndarray() for f in resampler.resample(frame))
+        chunks.extend(f.to_ndarray() for f in resampler.resample(None))
+    if not chunks:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(chunks, axis=1).ravel().astype(np.float32, copy=False)
+
+
+class StreamingResampler:
+    """Stateful polyphase resampler and downmixer for interleaved PCM blocks.
+
+    Converts int16 or float32 audio with any channel count and sample rate
+    to float32 mono at out_rate. The rate change is the reduced ratio up/down
+    (e.g. 441 -> 160 for 44.1 kHz to 16 kHz), filtered by a Kaiser-windowed
+    sinc split into ``up`` phases of ``taps`` coefficients. Each block is
+    processed in one vectorised pass: every output sample is a dot product
+    of ``taps`` input samples with the coefficients of its phase. The last
+    ``taps - 1`` input samples and any partial multi-channel frame carry
+    over to the next block, so block boundaries leave no artefacts.
+    """
+
+    def __init__(self, in_rate: int, out_rate: int = 16000, channels: int = 1, taps: int = 24, beta: float = 8.0):
+        g = np.gcd(in_rate, out_rate)
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+        self.channels = channels
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps
+        if self.up != self.down:
+            # Low-pass at 90% of the lower Nyquist frequency, in units of the upsampled rate
+            n = taps * self.up
+            cutoff = 0.45 / max(self.up, self.down)
+            t = np.arange(n) - (n - 1) / 2
+            h = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(n, beta) * self.up
+            # phases[p, k] = h[p + k * up], reversed so it lines up with ascending input windows
+            self._phases = h.reshape(taps, self.up).T[:, ::-1].astype(np.float32)
+        self._history = np.zeros(taps - 1, dtype=np.float32)
+        self._remainder = None   # samples of an incomplete multi-channel frame
+        self._in = 0             # mono input samples consumed
+        self._out = 0            # output samples produced
+
+    @property
+    def passthrough(self) -> bool:
+        return self.up == self.down and self.channels == 1
+
+    def process(self, samples: np.ndarray, scale: float = 1.0) -> np.ndarray:
+        """Interleaved samples in, float32 mono at out_rate out (times scale)."""
+        mono = self._downmix(samples, scale)
+        if self.up == self.down or len(mono) == 0:
+            return mono
+        total = self._in + len(mono)
+        # Output n needs input up to floor(n * down / up), which must already have arrived
+        first, end = self._out, (total * self.up + self.down - 1) // self.down
+        n = np.arange(first, end, dtype=np.int64)
+        base = n * self.down // self.up
+        extended = np.concatenate([self._history, mono])
+        windows = np.lib.stride_tricks.sliding_window_view(extended, self.taps)[base - self._in]
+        out = np.einsum("ij,ij->i", windows, self._phases[n * self.down % self.up])
+        self._history = extended[len(extended) - (self.taps - 1):]
+        self._in, self._out = total, end
+        return out
+
+    def _downmix(self, samples: np.ndarray, scale: float) -> np.ndarray:
+        if self.channels == 1:
+            return np.multiply(samples, scale, dtype=np.float32)
+        if self._remainder is not None:
+            samples = np.concatenate([self._remainder, samples])
+        whole = len(samples) - len(samples) % self.channels
+        self._remainder = samples[whole:] if whole < len(samples) else None
+        frames = samples[:whole].reshape(-1, self.channels)
+        return np.multiply(frames.mean(axis=1, dtype=np.float32), scale, dtype=np.float32)
+
+
+def split_on_silence(audio: np.ndarray, sample_rate: int = 16000, max_chunk_sec: float = 30.0,
+                     search_sec: float = 5.0, frame_ms: int = 30) -> list:
+    """Split audio into (start, end) sample ranges of at most max_chunk_sec.
+
+    Each cut is placed on the quietest frame in the last search_sec seconds
+    before the limit, so chunks rarely split a word.
+    """
+    max_len = max(1, int(max_chunk_sec * sample_rate))
+    search = min(max_len, int(search_sec * sample_rate))
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    chunks = []
+    start = 0
+    while len(audio) - start > max_len:
+        lo = start + max_len - search
+        k = search // frame
+        if k == 0:
+            cut = start + max_len
+        else:
+            region = audio[lo:lo + k * frame].reshape(k, frame)
+            cut = lo + int(np.argmin(np.mean(region * region, axis=1))) * frame + frame // 2
+        chunks.append((start, cut))
+        start = cut
+    if start < len(audio):
+        chunks.append((start, len(audio)))
+    return chunks
+
+
+class BytePipe(io.RawIOBase):
+    """Blocking, non-seekable byte stream fed from another thread.
+
+    read() blocks until data is written or the pipe is closed for writing,
+    which lets a demuxer consume a network stream as if it were a file.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = collections.deque()
+        self._cond = threading.Condition()
+        self._eof = False
+        self._discard = False
+
+    def write_chunk(self, data: bytes):
+        with self._cond:
+            if self._discard:
+                return
+            self._chunks.append(data)
+            self._cond.notify()
+
+    def close_input(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify()
+
+    def discard(self):
+        """Drop everything buffered and anything written from now on (the reader has gone away)."""
+        with self._cond:
+            self._chunks.clear()
+            self._eof = True
+            self._discard = True
+            self._cond.notify()
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def read(self, size: int = -1) -> bytes:
+        with self._cond:
+            while not self._chunks and not self._eof:
+                self._cond.wait()
+            if not self._chunks:
+                return b''
+            if size is None or size < 0:
+                data = b''.join(self._chunks)
+                self._chunks.clear()
+                return data
+            data = self._chunks.popleft()
+            if len(data) > size:
+                self._chunks.appendleft(data[size:])
+                data = data[:size]
+            return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class StreamingAudioDecoder:
+    """Long-lived compressed-audio decoder for one connection.
+
+    Incoming chunks (e.g. MediaRecorder WebM/Opus slices) are concatenated
+    into a single stream and demuxed, decoded and resampled to 16-bit mono
+    PCM on a dedicated thread. The container and resampler are opened once,
+    so chunks without their own headers decode fine and no audio is dropped.
+    Decoded PCM is delivered to ``on_pcm`` on the event loop.
+    """
+
+    def __init__(self, on_pcm, loop: asyncio.AbstractEventLoop, sample_rate: int = 16000, container_format: str = None):
+        self.on_pcm = on_pcm
+        self.loop = loop
+        self.sample_rate = sample_rate
+        self.container_format = container_format
+        self.bytes_in = 0
+        self.samples_out = 0
+        self.error = None
+        self._pipe = BytePipe()
+        self._thread = threading.Thread(target=self._run, name="audio-decoder", daemon=True)
+        self._thread.start()
+
+    @property
+    def failed(self) -> bool:
+        """True once the decoder has given up on the stream; further input is dropped."""
+        return self.error is not None
+
+    def feed(self, data: bytes):
+        if self.failed or not self._thread.is_alive():
+            return
+        self.bytes_in += len(data)
+        self._pipe.write_chunk(data)
+
+    def close(self):
+        """Signal end of stream; the decoder flushes what it has and exits."""
+        self._pipe.close_input()
+
+    def _deliver(self, pcm: bytes):
+        self.samples_out += len(pcm) // 2
+        self.on_pcm(pcm)
+
+    def _run(self):
+        try:
+            # Small probe so the first PCM comes out after a few chunks, not megabytes
+            with av.open(self._pipe, mode='r', format=self.container_format,
+                         options={"probesize": "32768", "analyzeduration": "0"}) as container:
+                if not container.streams.audio:
+                    raise ValueError("no audio stream in input")
+                stream = container.streams.audio[0]
+                resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=self.sample_rate)
+                for frame in container.decode(stream):
+                    self._emit(resampler.resample(frame))
+                self._emit(resampler.resample(None))
+        except Exception as e:
+            self.error = e
+            self._pipe.discard()  # nothing reads the pipe any more
+            log.warning("Audio decoder stopped after %d bytes: %s", self.bytes_in, e)
+
+    def _emit(self, frames):
+        # to_ndarray() trims the plane padding that to_bytes() would include
+        pcm = b''.join(frame.to_ndarray().tobytes() for frame in frames)
+        if pcm and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._deliver, pcm)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for the streaming endpoints.
+
+Starts the app in-process under uvicorn, streams fixture audio from N
+simulated clients at real-time pace over /ws-pcm16 (raw PCM16) or /ws
+(WebM/Opus), and reports time to first text, update latency, real-time
+factor and CPU/memory per session.
+
+By default Whisper is replaced by FakeWhisperModel, whose compute time is
+configurable, so scheduling and buffering changes can be measured offline
+without downloading a model. Pass --real to benchmark the real model.
+
+    python bench.py --sessions 1,10,20 --seconds 30
+    python bench.py --sessions 8 --mode incremental --fake-latency-ms 300
+    python bench.py --real --model base.en --audio sample.wav --endpoint ws
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+import types
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+
+class FakeWhisperModel:
+    """Stand-in for faster_whisper.WhisperModel with a fixed compute cost.
+
+    Whisper always encodes a padded 30 s window, so one decode costs
+    ``latency`` seconds however short the audio is; each extra window in a
+    batched encode adds ``batch_cost`` of that. The time is spent in
+    time.sleep(), which releases the GIL the way CTranslate2 does. Text is a
+    word every half second (" w0 w1 ...").
+    """
+
+    latency = 0.15
+    batch_cost = 0.3
+
+    def __init__(self, model_size_or_path: str, device: str = "cpu", compute_type: str = "default",
+                 num_workers: int = 1, **kwargs):
+        from faster_whisper.feature_extractor import FeatureExtractor
+        self.feature_extractor = FeatureExtractor()
+        self.hf_tokenizer = _FakeTokenizer()
+        self.model = _FakeCTranslate2Model(self)
+        self.max_length = 448
+        self.calls = 0
+
+    def transcribe(self, audio, word_timestamps: bool = False, **kwargs):
+        self.calls += 1
+        duration = len(audio) / SAMPLE_RATE
+        self.compute(max(1, int(np.ceil(duration / 30.0))))
+        words = [types.SimpleNamespace(start=i * 0.5, end=i * 0.5 + 0.4, word=f" w{i}", probability=0.9)
+                 for i in range(int(duration * 2))]
+        segment = types.SimpleNamespace(start=0.0, end=duration, text="".join(w.word for w in words),
+                                        words=words if word_timestamps else None,
+                                        avg_logprob=-0.2, no_speech_prob=0.01)
+        info = types.SimpleNamespace(language="en", language_probability=1.0, duration=duration)
+        return iter([segment] if words else []), info
+
+    def get_prompt(self, tokenizer, previous_tokens, without_timestamps: bool = False, prefix=None, **kwargs):
+        return [tokenizer.sot]
+
+    def compute(self, windows: int):
+        time.sleep(self.latency * (1 + self.batch_cost * (windows - 1)))
+
+
+class _FakeCTranslate2Model:
+    # Just enough of ctranslate2.models.Whisper for server.decode_batch
+    is_multilingual = False
+
+    def __init__(self, owner: FakeWhisperModel):
+        self.owner = owner
+
+    def encode(self, features, to_cpu: bool = False):
+        return features.shape[0]
+
+    def generate(self, encoder_output, prompts, **kwargs):
+        self.owner.calls += 1
+        self.owner.compute(encoder_output)
+        return [types.SimpleNamespace(sequences_ids=[list(range(8))], no_speech_prob=0.0) for _ in prompts]
+
+
+class _FakeTokenizer:
+    # Special tokens sort after text tokens, as in the real vocabulary
+    SPECIALS = ["<|endoftext|>", "<|startoftranscript|>", "<|transcribe|>", "<|translate|>",
+                "<|startoflm|>", "<|startofprev|>", "<|nospeech|>", "<|notimestamps|>"]
+
+    def token_to_id(self, token: str):
+        return 50257 + self.SPECIALS.index(token) if token in self.SPECIALS else None
+
+    def encode(self, text: str, add_special_tokens: bool = False):
+        return types.SimpleNamespace(ids=list(range(len(text.split()))))
+
+    def decode(self, ids) -> str:
+        return " ".join(f"w{i}" for i in ids)
+
+
+def install_fake_model(latency: float, batch_cost: float):
+    """Make the model registry build FakeWhisperModel instead of downloading Whisper."""
+    import model_registry
+    FakeWhisperModel.latency = latency
+    FakeWhisperModel.batch_cost = batch_cost
+    model_registry.WhisperModel = FakeWhisperModel
+    model_registry.download_model = lambda name, **kwargs: name
+
+
+def serve_fake_inference(latency: float, batch_cost: float):
+    """Entry point for a shared inference process (INFERENCE_EXECUTOR=remote) using the stand-in."""
+    install_fake_model(latency, batch_cost)
+    import inference_server
+    inference_server.serve()
+
+
+def synth_speech(seconds: float, seed: int = 0) -> np.ndarray:
+    """Float32 fixture: 2.5 s voiced bursts separated by 1 s of low noise, so the VAD sees utterances."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    voiced = (t % 3.5) < 2.5
+    tone = 0.2 * np.sin(2 * np.pi * 180 * t) * (1 + 0.5 * np.sin(2 * np.pi * 3 * t))
+    return (np.where(voiced, tone, 0.0) + rng.normal(0, 0.003, len(t))).astype(np.float32)
+
+
+def encode_webm(audio: np.ndarray) -> bytes:
+    """Encode float32 mono audio as WebM/Opus, like a browser MediaRecorder would."""
+    import av
+    out = io.BytesIO()
+    with av.open(out, mode="w", format="webm") as container:
+        stream = container.add_stream("libopus", rate=48000)
+        resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=48000)
+        frame = av.AudioFrame.from_ndarray(audio[None, :], format="flt", layout="mono")
+        frame.sample_rate = SAMPLE_RATE
+        for resampled in resampler.resample(frame) + resampler.resample(None):
+            for packet in stream.encode(resampled):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+    return out.getvalue()
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "n": 0}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(p50 * 1000, 1), "p95": round(p95 * 1000, 1), "p99": round(p99 * 1000, 1), "n": len(values)}
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak, not current, off Linux
+
+
+class ClientResult:
+    def __init__(self):
+        self.first_send = None
+        self.first_text = None      # seconds from first audio sent to first text received
+        self.latencies = []         # newest audio sent -> text received, per update
+        self.messages = 0
+        self.degraded = 0           # "degrade" control messages from the server
+        self.error = None
+
+
+async def run_client(url: str, payload: bytes, duration: float, chunk_ms: int, tail: float, start_delay: float):
+    import websockets
+    result = ClientResult()
+    await asyncio.sleep(start_delay)
+    chunks = max(1, int(duration * 1000 / chunk_ms))
+    step = -(-len(payload) // chunks)
+    last_sent = None
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            def on_message(message: str, now: float):
+                text = message
+                if message.startswith("{"):
+                    data = json.loads(message)
+                    if data.get("type") == "degrade":
+                        result.degraded += 1
+                    text = data.get("text", "")
+                if not text:
+                    return  # control message or cleared partial
+                result.messages += 1
+                if result.first_text is None:
+                    result.first_text = now - result.first_send
+                result.latencies.append(now - last_sent)
+
+            async def receive():
+                try:
+                    async for message in ws:
+                        on_message(message, time.perf_counter())
+                except websockets.ConnectionClosed:
+                    pass  # reported by the sender
+
+            receiver = asyncio.create_task(receive())
+            started = time.perf_counter()
+            result.first_send = started
+            for i in range(chunks):
+                # Pace against the start time so send jitter doesn't accumulate
+                await asyncio.sleep(max(0.0, started + i * chunk_ms / 1000 - time.perf_counter()))
+                await ws.send(payload[i * step:(i + 1) * step])
+                last_sent = time.perf_counter()
+            await ws.send("flush")
+            await asyncio.sleep(tail)
+            receiver.cancel()
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+
+async def run_level(server, base_url: str, token: str, args, sessions: int, audio: np.ndarray) -> dict:
+    path = "/ws" if args.endpoint == "ws" else "/ws-pcm16"
+    url = f"{base_url}{path}?token={token}&mode={args.mode}"
+    if args.model:
+        url += f"&model={args.model}"
+    if args.mode == "window":
+        url += "&control=1"
+    duration = len(audio) / SAMPLE_RATE
+    payload = encode_webm(audio) if args.endpoint == "ws" else (np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes()
+
+    # Worker time from the scheduler itself: one entry per job, however many windows a batch held
+    run_time_before = server.scheduler.total_run_time
+    rejected_before = server.scheduler.rejected
+    cpu_before = time.process_time()
+    rss_before = rss_mb()
+    rss_peak = rss_before
+    stop = asyncio.Event()
+
+    async def sample_memory():
+        nonlocal rss_peak
+        while not stop.is_set():
+            rss_peak = max(rss_peak, rss_mb())
+            await asyncio.sleep(0.25)
+
+    sampler = asyncio.create_task(sample_memory())
+    wall = time.perf_counter()
+    # Stagger connects over one chunk so sessions don't all send in lockstep
+    results = await asyncio.gather(*(
+        run_client(url, payload, duration, args.chunk_ms, args.tail, i * args.chunk_ms / 1000 / sessions)
+        for i in range(sessions)
+    ))
+    wall = time.perf_counter() - wall
+    stop.set()
+    await sampler
+
+    decode_sec = server.scheduler.total_run_time - run_time_before
+    audio_sec = duration * sessions
+    return {
+        "sessions": sessions,
+        "errors": [r.error for r in results if r.error],
+        "time_to_first_text_ms": percentiles([r.first_text for r in results if r.first_text is not None]),
+        "update_latency_ms": percentiles([x for r in results for x in r.latencies]),
+        "messages_per_session": round(sum(r.messages for r in results) / sessions, 1),
+        "degrade_messages": sum(r.degraded for r in results),
+        "rtf": round(decode_sec / audio_sec, 3),   # worker time per second of audio
+        "cpu_sec_per_session": round((time.process_time() - cpu_before) / sessions, 3),
+        "rss_mb_per_session": round((rss_peak - rss_before) / sessions, 2),
+        "rss_peak_mb": round(rss_peak, 1),
+        "rejected_decodes": server.scheduler.rejected - rejected_before,
+        "wall_sec": round(wall, 1),
+        "inference": server.scheduler.stats(),
+    }
+
+
+def start_server(app, port: int):
+    """Run uvicorn on its own thread and event loop; returns the uvicorn.Server."""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=2 ** 24))
+    threading.Thread(target=server.run, name="bench-server", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def print_report(level: dict):
+    ttft, upd = level["time_to_first_text_ms"], level["update_latency_ms"]
+    print(f"sessions={level['sessions']:<4} first text p50/p95/p99={ttft['p50']}/{ttft['p95']}/{ttft['p99']} ms  "
+          f"update p50/p95/p99={upd['p50']}/{upd['p95']}/{upd['p99']} ms  rtf={level['rtf']}  "
+          f"cpu/session={level['cpu_sec_per_session']}s  rss/session={level['rss_mb_per_session']}MB  "
+          f"rejected={level['rejected_decodes']}  degraded={level['degrade_messages']}  errors={len(level['errors'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", default="1,4,8", help="comma-separated concurrency levels, run in order")
+    parser.add_argument("--seconds", type=float, default=20.0, help="audio streamed per session")
+    parser.add_argument("--audio", help="fixture file (any format av reads); default is synthetic speech-like audio")
+    parser.add_argument("--endpoint", choices=["pcm16", "ws"], default="pcm16", help="/ws-pcm16 or /ws (WebM/Opus)")
+    parser.add_argument("--mode", default="window", choices=["window", "incremental", "speculative"])
+    parser.add_argument("--model", help="?model= for every session")
+    parser.add_argument("--chunk-ms", type=int, default=100, help="audio per message")
+    parser.add_argument("--tail", type=float, default=3.0, help="seconds to wait for text after the last chunk")
+    parser.add_argument("--real", action="store_true", help="use the real Whisper model instead of the stand-in")
+    parser.add_argument("--fake-latency-ms", type=float, default=150.0, help="stand-in compute time per decode")
+    parser.add_argument("--fake-batch-cost", type=float, default=0.3,
+                        help="stand-in cost of each extra window in a batch, as a fraction of one decode")
+    parser.add_argument("--json", help="write the full results to this file")
+    args = parser.parse_args()
+
+    # The server reads its configuration at import time
+    os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db"))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # Every simulated client streams the same audio, which the transcription cache would answer for free
+    os.environ.setdefault("CACHE_MEMORY_MB", "0")
+    # Speculative mode is opt-in on the server
+    os.environ.setdefault("STREAMING_MODES", args.mode)
+    if os.environ.get("INFERENCE_EXECUTOR") == "remote":
+        # Shared inference process, as start.py would run it
+        import multiprocessing
+        import inference_server
+        target, target_args = inference_server.serve, ()
+        if not args.real:
+            target, target_args = serve_fake_inference, (args.fake_latency_ms / 1000, args.fake_batch_cost)
+        multiprocessing.get_context("spawn").Process(target=target, args=target_args, daemon=True).start()
+    elif not args.real:
+        # The stand-in only exists in this process; a process pool would load the real model
+        os.environ["INFERENCE_EXECUTOR"] = "thread"
+        install_fake_model(args.fake_latency_ms / 1000, args.fake_batch_cost)
+
+    import server as server_module
+    from audio import decode_audio_file
+    from jose import jwt
+
+    if args.audio:
+        with open(args.audio, "rb") as f:
+            audio = decode_audio_file(f, SAMPLE_RATE)[:int(args.seconds * SAMPLE_RATE)]
+    else:
+        audio = synth_speech(args.seconds)
+
+    port = free_port()
+    uv = start_server(server_module.app, port)
+    while not server_module.registry.is_ready():
+        time.sleep(0.1)
+    token = jwt.encode({"sub": "bench"}, server_module.SECRET, algorithm=server_module.ALGO)
+
+    config = {k: v for k, v in vars(args).items() if k != "json"}
+    print(f"endpoint=/{'ws' if args.endpoint == 'ws' else 'ws-pcm16'} mode={args.mode} "
+          f"model={'real' if args.real else 'fake'} audio={len(audio) / SAMPLE_RATE:.1f}s "
+          f"workers={server_module.INFERENCE_WORKERS} batch={server_module.BATCH_MAX_SIZE}")
+    levels = []
+    for sessions in [int(n) for n in args.sessions.split(",") if n.strip()]:
+        level = asyncio.run(run_level(server_module, f"ws://127.0.0.1:{port}", token, args, sessions, audio))
+        print_report(level)
+        levels.append(level)
+
+    uv.should_exit = True
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"config": config, "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Content-addressed cache of transcription results.
+
+Keys are a hash of the decoded audio samples plus everything that affects
+the decode (model, language, decode parameters), so a re-uploaded file, or
+the same window seen twice, is answered without touching the model. Results
+live in an in-memory LRU tier and, optionally, an on-disk tier; both evict
+least recently used entries to stay under a size cap.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+CACHE_VERSION = 1  # bump when decoding changes in a way the key doesn't capture
+DISK_RESCAN_SEC = 60  # how often the disk index is rebuilt to pick up other workers' entries
+
+
+class TranscriptCache:
+    """Two-tier LRU cache of JSON-serialisable results. Thread-safe; disk access blocks.
+
+    Several processes may share disk_dir: each rescans the directory before
+    evicting and every DISK_RESCAN_SEC, so the cap applies to the directory
+    as a whole rather than to each process's own writes.
+    """
+
+    def __init__(self, memory_mb: float = 64, disk_dir: str = None, disk_mb: float = 1024):
+        self.memory_cap = int(memory_mb * 1024 * 1024)   # 0 disables the memory tier
+        self.disk_dir = disk_dir                          # None disables the disk tier
+        self.disk_cap = int(disk_mb * 1024 * 1024)
+        self._memory = collections.OrderedDict()          # key -> (value, size), least recently used first
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()            # key -> size
+        self._disk_bytes = 0
+        self._rescan_at = 0.0
+        self._lock = threading.Lock()
+        # Stats
+        self.hits = collections.Counter()
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._scan_disk()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.memory_cap or self.disk_dir)
+
+    @staticmethod
+    def key(audio: np.ndarray, **params) -> str:
+        """Hash of the samples and decode parameters; hashlib releases the GIL, so run it on a thread."""
+        h = hashlib.sha256()
+        h.update(json.dumps({"v": CACHE_VERSION, **params}, sort_keys=True).encode())
+        h.update(np.ascontiguousarray(audio, dtype=np.float32).data)
+        return h.hexdigest()
+
+    def get(self, key: str, kind: str = "file"):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._hit("memory", kind)
+                return entry[0]
+        if self.disk_dir:
+            # Look on disk even when the index doesn't know the key: another worker may have written it
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+                value = json.loads(data)
+                os.utime(self._path(key))  # survives a restart's LRU rebuild
+            except FileNotFoundError:
+                with self._lock:  # never written, or evicted by another worker
+                    self._disk_bytes -= self._disk.pop(key, 0)
+            except (OSError, ValueError) as e:
+                log.warning("Dropping unreadable cache entry %s: %s", key, e)
+                self._forget_disk(key)
+            else:
+                with self._lock:
+                    self._disk_bytes += len(data) - self._disk.pop(key, 0)
+                    self._disk[key] = len(data)
+                    self._put_memory(key, value, len(data))
+                    self._hit("disk", kind)
+                return value
+        with self._lock:
+            self.misses += 1
+        metrics.CACHE_REQUESTS.labels("miss", kind).inc()
+        return None
+
+    def put(self, key: str, value):
+        data = json.dumps(value).encode()
+        with self._lock:
+            self._put_memory(key, value, len(data))
+        if self.disk_dir and len(data) <= self.disk_cap:
+            tmp = self._path(key) + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                os.replace(tmp, self._path(key))  # readers never see a partial file
+            except OSError as e:
+                log.warning("Could not write cache entry %s: %s", key, e)
+                return
+            with self._lock:
+                self._disk_bytes += len(data) - self._disk.pop(key, 0)
+                self._disk[key] = len(data)
+                rescan = self._disk_bytes > self.disk_cap or time.monotonic() >= self._rescan_at
+            if rescan:
+                self._scan_disk()
+        self._update_gauges()
+
+    def _hit(self, tier: str, kind: str):
+        # Called with _lock held
+        self.hits[tier] += 1
+        metrics.CACHE_REQUESTS.labels(tier, kind).inc()
+
+    def _put_memory(self, key: str, value, size: int):
+        # Called with _lock held
+        if not self.memory_cap or size > self.memory_cap:
+            return
+        if key in self._memory:
+            self._memory_bytes -= self._memory.pop(key)[1]
+        self._memory[key] = (value, size)
+        self._memory_bytes += size
+        while self._memory_bytes > self.memory_cap:
+            _, (_, old) = self._memory.popitem(last=False)
+            self._memory_bytes -= old
+
+    def _evict_disk(self) -> list:
+        # Called with _lock held; returns keys whose files should be removed
+        victims = []
+        while self._disk_bytes > self.disk_cap and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            victims.append(key)
+        return victims
+
+    def _forget_disk(self, key: str):
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key + ".json")
+
+    def _scan_disk(self):
+        # Rebuild the disk LRU from modification times, oldest first, then evict down to the cap
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                try:
+                    st = os.stat(os.path.join(self.disk_dir, name))
+                except OSError:
+                    continue  # removed by another worker since listdir
+                entries.append((st.st_mtime, name[:-5], st.st_size))
+        disk = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+        with self._lock:
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+            self._rescan_at = time.monotonic() + DISK_RESCAN_SEC
+            victims = self._evict_disk()
+        for victim in victims:
+            self._unlink(victim)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        metrics.CACHE_BYTES.labels("memory").set(self._memory_bytes)
+        metrics.CACHE_BYTES.labels("disk").set(self._disk_bytes)
+
+    def stats(self) -> dict:
+        lookups = sum(self.hits.values()) + self.misses
+        return {
+            "memory_entries": len(self._memory),
+            "memory_mb": round(self._memory_bytes / (1024 * 1024), 2),
+            "disk_entries": len(self._disk),
+            "disk_mb": round(self._disk_bytes / (1024 * 1024), 2),
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": round(sum(self.hits.values()) / lookups, 3) if lookups else None,
+        }
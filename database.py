@@ -1,9 +1,12 @@
 import os
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, text, Column, Integer, String, DateTime, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import DBAPIError
 from datetime import datetime
 
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
 # Database URL from Railway environment variable
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -13,29 +16,40 @@ if DATABASE_URL:
     if DATABASE_URL.startswith("postgres://"):
         DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
     
-    engine = create_engine(DATABASE_URL)
+    engine = create_engine(
+        DATABASE_URL,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        pool_pre_ping=True,   # drop connections Railway has closed while idle
+        pool_recycle=1800,
+    )
 else:
-    # Fallback for local development
-    engine = create_engine("sqlite:///./whisper_app.db")
+    # Fallback for local development; writes happen on worker threads
+    engine = create_engine("sqlite:///./whisper_app.db", connect_args={"check_same_thread": False})
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
 # Database Models
+# Schema changes go through Alembic migrations in migrations/versions, not just these models
 class TranscriptionSession(Base):
     __tablename__ = "transcription_sessions"
+    # A user's sessions, newest first, for keyset pagination (id breaks ties)
+    __table_args__ = (Index("ix_transcription_sessions_user_token_created_at", "user_token", "created_at", "id"),)
     
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(String, unique=True, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    user_token = Column(String, index=True)
+    user_token = Column(String)
 
 class TranscriptionResult(Base):
     __tablename__ = "transcription_results"
+    # A session's transcript in order, for keyset pagination and export (id breaks ties)
+    __table_args__ = (Index("ix_transcription_results_session_id_timestamp", "session_id", "timestamp", "id"),)
     
     id = Column(Integer, primary_key=True, index=True)
-    session_id = Column(String, index=True)
+    session_id = Column(String)
     text = Column(Text)
     timestamp = Column(DateTime, default=datetime.utcnow)
     audio_duration = Column(Integer)  # in milliseconds
@@ -49,6 +63,24 @@ def get_db():
     finally:
         db.close()
 
+def migrate():
+    """Bring the schema up to date with the Alembic migrations."""
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config()
+    config.set_main_option("script_location", MIGRATIONS_DIR)
+    command.upgrade(config, "head")
+
 # Create tables
 def create_tables():
-    Base.metadata.create_all(bind=engine)
+    try:
+        migrate()
+    except DBAPIError:
+        # Several web workers start at once; another one may have migrated first
+        migrate()
+
+# Blocking connectivity check, run it off the event loop
+def check_connection():
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
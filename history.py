@@ -0,0 +1,124 @@
+"""
+Read side of the transcript store: paginated history and bulk export.
+
+Pages use keyset pagination: the cursor encodes the (time, id) of the last
+row returned and the next page starts strictly after it. Each page is one
+range scan of a composite index, however deep into the history it is, and
+rows written in the meantime never shift or repeat a page. Exports stream
+rows through a server-side cursor, so memory stays flat however many rows
+there are. All functions block; run them off the event loop.
+"""
+import base64
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import select, tuple_
+
+from database import SessionLocal, TranscriptionResult, TranscriptionSession, engine
+
+EXPORT_BATCH_ROWS = 1000  # rows fetched per round trip, and per chunk of the response
+EXPORT_FIELDS = ["session_id", "id", "timestamp", "text", "audio_duration", "confidence"]
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(when: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{when.isoformat()}|{row_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        when, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(when), int(row_id)
+    except ValueError as e:
+        raise InvalidCursor(f"invalid cursor: {cursor!r}") from e
+
+
+def _isoformat(when: datetime):
+    return when.isoformat() if when is not None else None
+
+
+def list_sessions(user_token: str, limit: int = 50, cursor: str = None) -> dict:
+    """A user's sessions, newest first."""
+    order = (TranscriptionSession.created_at, TranscriptionSession.id)
+    query = select(TranscriptionSession).where(TranscriptionSession.user_token == user_token)
+    if cursor:
+        query = query.where(tuple_(*order) < decode_cursor(cursor))
+    query = query.order_by(*(column.desc() for column in order)).limit(limit + 1)
+    with SessionLocal() as db:
+        rows = db.execute(query).scalars().all()
+    page, more = rows[:limit], len(rows) > limit
+    return {
+        "sessions": [{"session_id": row.session_id, "created_at": _isoformat(row.created_at)} for row in page],
+        "next_cursor": encode_cursor(page[-1].created_at, page[-1].id) if more else None,
+    }
+
+
+def owns_session(session_id: str, user_token: str) -> bool:
+    query = select(TranscriptionSession.id).where(TranscriptionSession.session_id == session_id,
+                                                  TranscriptionSession.user_token == user_token)
+    with SessionLocal() as db:
+        return db.execute(query).first() is not None
+
+
+def get_transcript(session_id: str, limit: int = 200, cursor: str = None) -> dict:
+    """A session's results in the order they were produced."""
+    order = (TranscriptionResult.timestamp, TranscriptionResult.id)
+    query = select(TranscriptionResult).where(TranscriptionResult.session_id == session_id)
+    if cursor:
+        query = query.where(tuple_(*order) > decode_cursor(cursor))
+    query = query.order_by(*order).limit(limit + 1)
+    with SessionLocal() as db:
+        rows = db.execute(query).scalars().all()
+    page, more = rows[:limit], len(rows) > limit
+    return {
+        "session_id": session_id,
+        "results": [_result(row) for row in page],
+        "next_cursor": encode_cursor(page[-1].timestamp, page[-1].id) if more else None,
+    }
+
+
+def _result(row) -> dict:
+    return {
+        "id": row.id,
+        "timestamp": _isoformat(row.timestamp),
+        "text": row.text,
+        "audio_duration": row.audio_duration,
+        "confidence": row.confidence,
+    }
+
+
+def export_results(user_token: str, session_id: str = None, fmt: str = "ndjson"):
+    """Yield a user's results (or one session's) as NDJSON or CSV text, a batch of rows per chunk."""
+    columns = [getattr(TranscriptionResult, name) for name in EXPORT_FIELDS]
+    query = (select(*columns)
+             .join(TranscriptionSession, TranscriptionSession.session_id == TranscriptionResult.session_id)
+             .where(TranscriptionSession.user_token == user_token))
+    if session_id:
+        query = query.where(TranscriptionResult.session_id == session_id)
+    query = query.order_by(TranscriptionResult.session_id, TranscriptionResult.timestamp, TranscriptionResult.id)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == "csv" else None
+    if writer:
+        writer.writerow(EXPORT_FIELDS)
+    with engine.connect() as conn:
+        # stream_results uses a server-side (named) cursor on PostgreSQL instead of fetching every row
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_BATCH_ROWS).execute(query)
+        for rows in result.partitions():
+            for row in rows:
+                values = [_isoformat(v) if isinstance(v, datetime) else v for v in row]
+                if writer:
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, values))) + "\n")
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
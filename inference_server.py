@@ -0,0 +1,373 @@
+"""
+Shared inference process for multi-worker deployments.
+
+One process holds the Whisper models and runs every decode; any number of
+web workers (uvicorn/hypercorn --workers) connect to it over a local socket.
+Audio windows travel through shared memory, so only small descriptors and
+the resulting text cross the socket, and the model weights exist once no
+matter how many web workers handle connections.
+
+Web workers use it with INFERENCE_EXECUTOR=remote: the scheduler hands jobs
+to a RemoteExecutor instead of a local pool, and RemoteModelRegistry stands
+in for the local ModelRegistry. start.py launches this process; it can also
+run on its own with ``python inference_server.py``.
+"""
+import asyncio
+import atexit
+import collections
+import functools
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from model_registry import ModelRegistry
+
+log = logging.getLogger(__name__)
+
+# Only these server functions may be called remotely
+DECODERS = ("decode_audio", "decode_batch", "decode_words", "decode_chunk")
+
+SharedAudio = collections.namedtuple("SharedAudio", "name offset length")
+
+
+class AudioSlots:
+    """Fixed-size float32 slots in one shared memory segment, reused across jobs.
+
+    Raises OSError if the segment can't be created, or (where the platform
+    can tell up front) if /dev/shm doesn't have room for all of it.
+    """
+
+    def __init__(self, slots: int, slot_samples: int):
+        self.slot_samples = slot_samples
+        size = slots * slot_samples * 4
+        self._shm = shared_memory.SharedMemory(create=True, size=size)
+        # Processes started with spawn share one resource tracker, which gets confused when several
+        # of them register the same segment; the creator unlinks it explicitly instead
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        if hasattr(os, "posix_fallocate"):
+            # The segment is sparse: without reserving it now, a full /dev/shm shows up as SIGBUS on first write
+            try:
+                os.posix_fallocate(self._shm._fd, 0, size)
+            except OSError:
+                self._shm.close()
+                resource_tracker.register(self._shm._name, "shared_memory")  # unlink() unregisters it again
+                self._shm.unlink()
+                raise
+        self._array = np.ndarray((slots, slot_samples), dtype=np.float32, buffer=self._shm.buf)
+        self._free = list(range(slots))  # heap: the lowest free slot goes out first
+        self._lock = threading.Lock()
+        atexit.register(self.close)  # the segment outlives the process unless unlinked
+
+    def put(self, audio: np.ndarray):
+        """Copy audio into a free slot; returns (SharedAudio, slot), or None if it must be sent inline."""
+        if len(audio) > self.slot_samples:
+            return None
+        with self._lock:
+            if not self._free:
+                return None
+            slot = heapq.heappop(self._free)
+        self._array[slot, :len(audio)] = audio
+        return SharedAudio(self._shm.name, slot * self.slot_samples * 4, len(audio)), slot
+
+    def release(self, slots: list):
+        with self._lock:
+            for slot in slots:
+                heapq.heappush(self._free, slot)
+
+    def close(self):
+        if self._array is None:
+            return
+        self._array = None
+        self._shm.close()
+        resource_tracker.register(self._shm._name, "shared_memory")  # unlink() unregisters it again
+        self._shm.unlink()
+
+
+class RemoteExecutor(Executor):
+    """concurrent.futures Executor that runs decodes in the inference process.
+
+    Connects (and reconnects) in the background; jobs submitted while the
+    inference process is unreachable fail with ConnectionError.
+    """
+
+    def __init__(self, address: str, authkey: bytes, slots: int = 8, slot_seconds: float = 30.0,
+                 sample_rate: int = 16000):
+        self.address = address
+        self._authkey = authkey
+        self._slots = None  # without shared memory, audio is pickled inline
+        if slots > 0:
+            try:
+                self._slots = AudioSlots(slots, int(slot_seconds * sample_rate))
+            except OSError as e:
+                log.warning("No shared memory for audio (%d x %.0fs slots), sending it inline: %s",
+                            slots, slot_seconds, e)
+        self._conn = None
+        self._connected = threading.Event()
+        self._send_lock = threading.Lock()
+        self._pending = {}  # job id -> (Future, slots to release)
+        self._ids = itertools.count()
+        self._closed = False
+        threading.Thread(target=self._run, name="inference-client", daemon=True).start()
+
+    def wait_connected(self, timeout: float = None) -> bool:
+        return self._connected.wait(timeout)
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if isinstance(fn, functools.partial):
+            fn, args, kwargs = fn.func, fn.args + args, {**fn.keywords, **kwargs}
+        slots = []
+        args = tuple(self._share(arg, slots) for arg in args)
+        return self._request(("run", fn.__name__, args, kwargs), slots)
+
+    def control(self, op: str, *args) -> Future:
+        """Send a non-decode request ("load" or "stats") to the inference process."""
+        return self._request((op,) + args, [])
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self._closed = True
+        if self._conn is not None:
+            self._conn.close()
+        self._fail_pending(ConnectionError("inference client shut down"))
+        if self._slots is not None:
+            self._slots.close()
+
+    def _share(self, arg, slots: list):
+        # Audio goes through shared memory; anything that doesn't fit is pickled inline
+        if isinstance(arg, np.ndarray) and arg.dtype == np.float32 and arg.ndim == 1 and self._slots is not None:
+            shared = self._slots.put(arg)
+            if shared is None:
+                return arg
+            slots.append(shared[1])
+            return shared[0]
+        if isinstance(arg, list):
+            return [self._share(item, slots) for item in arg]
+        return arg
+
+    def _request(self, message: tuple, slots: list) -> Future:
+        future = Future()
+        if not self._connected.is_set():
+            self._release(slots)
+            future.set_exception(ConnectionError(f"inference process at {self.address} is not reachable"))
+            return future
+        job_id = next(self._ids)
+        self._pending[job_id] = (future, slots)
+        try:
+            with self._send_lock:
+                self._conn.send((message[0], job_id) + message[1:])
+        except (OSError, ValueError) as e:
+            self._complete(job_id, False, ConnectionError(f"inference process connection lost: {e}"))
+        return future
+
+    def _complete(self, job_id: int, ok: bool, value):
+        entry = self._pending.pop(job_id, None)
+        if entry is None:
+            return
+        future, slots = entry
+        self._release(slots)
+        if future.cancelled():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def _release(self, slots: list):
+        if slots:
+            self._slots.release(slots)
+
+    def _fail_pending(self, error: Exception):
+        for job_id in list(self._pending):
+            self._complete(job_id, False, error)
+
+    def _run(self):
+        while not self._closed:
+            try:
+                self._conn = Client(self.address, authkey=self._authkey)
+            except (OSError, EOFError):
+                time.sleep(0.5)  # inference process still starting (or restarting)
+                continue
+            log.info("Connected to inference process at %s", self.address)
+            self._connected.set()
+            try:
+                while True:
+                    job_id, ok, value = self._conn.recv()
+                    self._complete(job_id, ok, value)
+            except (OSError, EOFError):
+                pass
+            self._connected.clear()
+            self._fail_pending(ConnectionError("inference process connection lost"))
+            if not self._closed:
+                log.warning("Lost connection to inference process at %s, reconnecting", self.address)
+
+
+_clients = {}
+
+
+def connect(address: str, authkey: bytes, slots: int = 8) -> RemoteExecutor:
+    """The process-wide client for address, shared by the scheduler and the registry.
+
+    slots is how many audio windows can be in flight through shared memory at
+    once; it only applies when the client is first created.
+    """
+    if address not in _clients:
+        _clients[address] = RemoteExecutor(address, authkey, slots)
+    return _clients[address]
+
+
+class RemoteModelRegistry(ModelRegistry):
+    """Model registry for web workers whose models live in the inference process.
+
+    Model names are validated locally; loading and readiness are delegated.
+    """
+
+    def __init__(self, address: str, authkey: bytes, default_model: str, allowed_models: list = None,
+                 internal_models: list = None):
+        super().__init__(default_model, allowed_models, internal_models)
+        self.address = address
+        self._authkey = authkey
+        self._remote_stats = None
+
+    def is_ready(self, name: str = None) -> bool:
+        return (name or self.default_model) in self._models
+
+    async def ensure_loaded(self, name: str = None):
+        name = name or self.default_model
+        if name in self._models:
+            return
+        client = connect(self.address, self._authkey)
+        await asyncio.to_thread(client.wait_connected)
+        self._remote_stats = await asyncio.wrap_future(client.control("load", name))
+        self._models = collections.OrderedDict((n, (None, 0)) for n in self._remote_stats["loaded"])
+
+    def get(self, name: str = None):
+        raise RuntimeError("models are loaded in the inference process, not in web workers")
+
+    load = get
+
+    def stats(self) -> dict:
+        stats = dict(self._remote_stats or {"default": self.default_model, "loaded": [],
+                                            "states": {n: "not loaded" for n in self.known_models}})
+        stats["inference_process"] = self.address
+        return stats
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        # The web worker owns the segment (see AudioSlots); don't let a tracker unlink it
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _resolve(arg, segments: dict):
+    if isinstance(arg, SharedAudio):
+        if arg.name not in segments:
+            segments[arg.name] = _attach(arg.name)
+        return np.ndarray((arg.length,), dtype=np.float32, buffer=segments[arg.name].buf, offset=arg.offset)
+    if isinstance(arg, list):
+        return [_resolve(item, segments) for item in arg]
+    return arg
+
+
+def _handle(conn, pool: ThreadPoolExecutor, server):
+    segments = {}
+    send_lock = threading.Lock()
+
+    def reply(job_id: int, ok: bool, value):
+        try:
+            with send_lock:
+                conn.send((job_id, ok, value))
+        except OSError:
+            pass  # web worker went away
+        except Exception as e:
+            # Result or exception that can't be pickled
+            with send_lock:
+                conn.send((job_id, False, RuntimeError(f"{type(value).__name__}: {value} ({e})")))
+
+    def run(job_id: int, fn, args: tuple, kwargs: dict):
+        try:
+            reply(job_id, True, fn(*args, **kwargs))
+        except Exception as e:
+            reply(job_id, False, e)
+
+    def load(job_id: int, name: str):
+        try:
+            server.registry.get(name)
+            reply(job_id, True, server.registry.stats())
+        except Exception as e:
+            reply(job_id, False, e)
+
+    try:
+        while True:
+            op, job_id, *rest = conn.recv()
+            if op == "run":
+                name, args, kwargs = rest
+                if name not in DECODERS:
+                    reply(job_id, False, ValueError(f"{name} cannot be called remotely"))
+                    continue
+                args = tuple(_resolve(arg, segments) for arg in args)
+                pool.submit(run, job_id, getattr(server, name), args, kwargs)
+            elif op == "load":
+                # Own thread: a model download must not hold up decodes for models already loaded
+                threading.Thread(target=load, args=(job_id, rest[0]), daemon=True).start()
+            elif op == "stats":
+                reply(job_id, True, server.registry.stats())
+            else:
+                reply(job_id, False, ValueError(f"unknown request {op}"))
+    except (OSError, EOFError):
+        pass
+    finally:
+        conn.close()
+        for shm in segments.values():
+            try:
+                shm.close()
+            except BufferError:
+                pass  # a decode still holds a view; the mapping goes away with the process
+
+
+def serve(address: str = None, authkey: bytes = None, threads: int = None):
+    """Run the inference process: load models, then serve decodes for web workers forever."""
+    # This process runs decodes itself, with the local model registry
+    os.environ["INFERENCE_EXECUTOR"] = "thread"
+    import server
+
+    address = address or server.INFERENCE_ADDRESS
+    authkey = authkey or server.SECRET.encode()
+    threads = threads or server.INFERENCE_WORKERS
+    if os.path.exists(address):
+        os.unlink(address)  # stale socket from a previous run
+    listener = Listener(address, authkey=authkey)
+    pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="inference")
+
+    def preload():
+        for name in server.startup_models():
+            try:
+                server.registry.get(name)
+            except Exception as e:
+                log.error("Failed to load model %s: %s", name, e)
+
+    threading.Thread(target=preload, name="preload", daemon=True).start()
+    log.info("Inference process listening on %s (%d decode threads, %s CPU threads each)",
+             address, threads, server.INFERENCE_CPU_THREADS or "default")
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # Failed handshake (e.g. wrong authkey); keep serving everyone else
+            log.warning("Rejected inference client: %s", e)
+            continue
+        threading.Thread(target=_handle, args=(conn, pool, server), name="inference-conn", daemon=True).start()
+
+
+if __name__ == "__main__":
+    serve()
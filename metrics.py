@@ -0,0 +1,62 @@
+"""
+Prometheus metrics for the transcription server, exposed at /metrics.
+"""
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RTF_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+ACTIVE_SESSIONS = Gauge("whisper_active_sessions", "Open streaming connections", ["endpoint"])
+REFUSED_SESSIONS = Counter("whisper_refused_sessions_total", "Connections refused by admission control", ["endpoint"])
+DEGRADED_SESSIONS = Counter("whisper_degraded_sessions_total", "Times a session was told to degrade because decodes lagged")
+FRAMES = Counter("whisper_frames_total", "Audio messages received", ["endpoint"])
+AUDIO_SECONDS = Counter("whisper_audio_seconds_total", "Seconds of audio received", ["endpoint"])
+DROPPED_FRAMES = Counter("whisper_dropped_frames_total", "Audio messages that could not be buffered or decoded",
+                         ["endpoint", "reason"])
+DROPPED_DECODES = Counter("whisper_dropped_decodes_total", "Decodes skipped or failed", ["reason"])
+
+DECODE_SECONDS = Histogram("whisper_decode_seconds", "Time a decode spent running on the worker pool",
+                           ["model", "kind"], buckets=LATENCY_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram("whisper_queue_wait_seconds", "Time a decode waited in the inference queue",
+                               ["kind"], buckets=LATENCY_BUCKETS)
+REALTIME_FACTOR = Histogram("whisper_realtime_factor", "Decode time divided by audio duration",
+                            ["model"], buckets=RTF_BUCKETS)
+E2E_LATENCY_SECONDS = Histogram("whisper_e2e_latency_seconds", "Newest audio received to text sent",
+                                ["endpoint"], buckets=LATENCY_BUCKETS)
+INFERENCE_QUEUE_DEPTH = Gauge("whisper_inference_queue_depth", "Decodes waiting for a worker")
+INFERENCE_LOAD = Gauge("whisper_inference_load", "Worker time in use plus queued work, as a fraction of capacity")
+
+CACHE_REQUESTS = Counter("whisper_cache_requests_total", "Transcription cache lookups by the tier that answered",
+                         ["tier", "kind"])
+CACHE_BYTES = Gauge("whisper_cache_bytes", "Size of cached transcription results", ["tier"])
+
+DB_QUEUE_DEPTH = Gauge("whisper_db_queue_depth", "Rows waiting to be written")
+DB_WRITE_LAG_SECONDS = Histogram("whisper_db_write_lag_seconds", "Row enqueued to row committed",
+                                 buckets=LATENCY_BUCKETS)
+DB_FAILED_BATCHES = Counter("whisper_db_failed_batches_total", "Bulk inserts that failed")
+
+
+def observe_decode(job, model: str, kind: str, audio_sec: float = None):
+    """Record run time and queue wait for a finished scheduler job, and its real-time factor if audio_sec is given."""
+    DECODE_SECONDS.labels(model, kind).observe(job.run_time)
+    QUEUE_WAIT_SECONDS.labels(kind).observe(job.queue_wait)
+    if audio_sec:
+        observe_rtf(model, job.run_time, audio_sec)
+
+
+def observe_rtf(model: str, run_time: float, audio_sec: float):
+    if audio_sec > 0:
+        REALTIME_FACTOR.labels(model).observe(run_time / audio_sec)
+
+
+def observe_latency(endpoint: str, last_audio_at: float):
+    """Record the time from the newest audio received (perf_counter) to now."""
+    if last_audio_at is not None:
+        E2E_LATENCY_SECONDS.labels(endpoint).observe(time.perf_counter() - last_audio_at)
+
+
+def render() -> tuple:
+    """Current metrics in the Prometheus text format, with its content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,50 @@
+"""Initial schema
+
+The tables as create_all() used to make them. Databases created before
+migrations existed already have them, so each table is only created if it
+is missing.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    existing = sa.inspect(op.get_bind()).get_table_names()
+    if "transcription_sessions" not in existing:
+        op.create_table(
+            "transcription_sessions",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("session_id", sa.String),
+            sa.Column("created_at", sa.DateTime),
+            sa.Column("updated_at", sa.DateTime),
+            sa.Column("user_token", sa.String),
+        )
+        op.create_index("ix_transcription_sessions_id", "transcription_sessions", ["id"])
+        op.create_index("ix_transcription_sessions_session_id", "transcription_sessions", ["session_id"], unique=True)
+        op.create_index("ix_transcription_sessions_user_token", "transcription_sessions", ["user_token"])
+    if "transcription_results" not in existing:
+        op.create_table(
+            "transcription_results",
+            sa.Column("id", sa.Integer, primary_key=True),
+            sa.Column("session_id", sa.String),
+            sa.Column("text", sa.Text),
+            sa.Column("timestamp", sa.DateTime),
+            sa.Column("audio_duration", sa.Integer),
+            sa.Column("confidence", sa.String),
+        )
+        op.create_index("ix_transcription_results_id", "transcription_results", ["id"])
+        op.create_index("ix_transcription_results_session_id", "transcription_results", ["session_id"])
+
+
+def downgrade():
+    op.drop_table("transcription_results")
+    op.drop_table("transcription_sessions")
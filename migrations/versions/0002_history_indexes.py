@@ -0,0 +1,43 @@
+"""Composite indexes for transcript history
+
+Keyset pagination reads a session's results ordered by (timestamp, id)
+and a user's sessions ordered by (created_at, id). The composite indexes
+serve those reads directly. They replace the single-column indexes they
+start with, which would only add write cost. On PostgreSQL they are built
+CONCURRENTLY, so large tables keep taking writes during the upgrade.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index("ix_transcription_results_session_id_timestamp", "transcription_results",
+                        ["session_id", "timestamp", "id"], postgresql_concurrently=True, if_not_exists=True)
+        op.create_index("ix_transcription_sessions_user_token_created_at", "transcription_sessions",
+                        ["user_token", "created_at", "id"], postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index("ix_transcription_results_session_id", "transcription_results",
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index("ix_transcription_sessions_user_token", "transcription_sessions",
+                      postgresql_concurrently=True, if_exists=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index("ix_transcription_results_session_id", "transcription_results", ["session_id"],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.create_index("ix_transcription_sessions_user_token", "transcription_sessions", ["user_token"],
+                        postgresql_concurrently=True, if_not_exists=True)
+        op.drop_index("ix_transcription_results_session_id_timestamp", "transcription_results",
+                      postgresql_concurrently=True, if_exists=True)
+        op.drop_index("ix_transcription_sessions_user_token_created_at", "transcription_sessions",
+                      postgresql_concurrently=True, if_exists=True)
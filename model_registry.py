@@ -0,0 +1,145 @@
+"""
+Registry of loaded Whisper models.
+
+Models are loaded on demand (or in the background at startup), warmed up
+with a short decode, and kept in LRU order under an approximate memory cap.
+Converted CTranslate2 models are cached in a local directory so restarts
+load from disk without touching the network.
+"""
+import asyncio
+import collections
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from faster_whisper import WhisperModel
+from faster_whisper.utils import download_model
+
+log = logging.getLogger(__name__)
+
+
+class ModelNotAllowed(Exception):
+    """Raised when a client asks for a model that is not in the allowed list."""
+
+
+class ModelRegistry:
+    """Loads the models clients may select (allowed_models) plus any the server uses itself (internal_models)."""
+
+    def __init__(self, default_model: str, allowed_models: list = None, internal_models: list = None,
+                 compute_type: str = "int8", num_workers: int = 1, cache_dir: str = None, memory_cap_mb: float = 0,
+                 cpu_threads: int = 0):
+        self.default_model = default_model
+        self.allowed_models = list(dict.fromkeys([default_model] + list(allowed_models or [])))
+        self.known_models = list(dict.fromkeys(self.allowed_models + list(internal_models or [])))
+        self.compute_type = compute_type
+        self.num_workers = num_workers       # CTranslate2 inter_threads: decodes that can run at once
+        self.cpu_threads = cpu_threads       # CTranslate2 intra_threads per decode, 0 = library default
+        self.cache_dir = cache_dir
+        self.memory_cap_mb = memory_cap_mb   # 0 means no cap
+        self._models = collections.OrderedDict()   # name -> (WhisperModel, size_mb), least recently used first
+        self._lock = threading.Lock()
+        self._load_locks = collections.defaultdict(threading.Lock)
+        self.states = {name: "not loaded" for name in self.known_models}
+        self.load_times = {}
+        self.evictions = 0
+
+    def resolve(self, name: str = None) -> str:
+        """Validate a requested model name, falling back to the default."""
+        name = name or self.default_model
+        if name not in self.allowed_models:
+            raise ModelNotAllowed(f"Model '{name}' is not available; choose from {', '.join(self.allowed_models)}")
+        return name
+
+    def is_ready(self, name: str = None) -> bool:
+        return (name or self.default_model) in self._models
+
+    def get(self, name: str = None) -> WhisperModel:
+        """Return a loaded model, loading it (blocking) if needed."""
+        name = name or self.default_model
+        with self._lock:
+            if name in self._models:
+                self._models.move_to_end(name)
+                return self._models[name][0]
+        return self.load(name)
+
+    async def ensure_loaded(self, name: str = None):
+        """Load a model off the event loop if it isn't loaded yet."""
+        if not self.is_ready(name):
+            await asyncio.to_thread(self.get, name)
+
+    def load(self, name: str) -> WhisperModel:
+        if name not in self.known_models:
+            raise ModelNotAllowed(f"Model '{name}' is not configured on this server")
+        with self._load_locks[name]:
+            with self._lock:
+                if name in self._models:
+                    return self._models[name][0]
+            started = time.perf_counter()
+            try:
+                self.states[name] = "loading"
+                path = self._model_path(name)
+                model = WhisperModel(path, device="cpu", compute_type=self.compute_type, num_workers=self.num_workers,
+                                     cpu_threads=self.cpu_threads)
+                self.states[name] = "warming up"
+                self._warmup(model)
+            except Exception as e:
+                self.states[name] = f"error: {e}"
+                raise
+            size_mb = _dir_size_mb(path)
+            with self._lock:
+                self._models[name] = (model, size_mb)
+                self._evict(keep=name)
+            self.states[name] = "ready"
+            self.load_times[name] = round(time.perf_counter() - started, 2)
+            log.info("Model %s ready in %ss (~%.0f MB)", name, self.load_times[name], size_mb)
+            return model
+
+    def _model_path(self, name: str) -> str:
+        if os.path.isdir(name):
+            return name
+        try:
+            # Cached copy first: no network round trip on restart
+            return download_model(name, local_files_only=True, cache_dir=self.cache_dir)
+        except Exception:
+            return download_model(name, cache_dir=self.cache_dir)
+
+    @staticmethod
+    def _warmup(model: WhisperModel):
+        # One short decode primes CTranslate2's kernels and allocators before real traffic
+        segments, _ = model.transcribe(np.zeros(16000, dtype=np.float32), beam_size=1, vad_filter=False)
+        for _ in segments:
+            pass
+
+    def _evict(self, keep: str):
+        # Called with _lock held. In-flight decodes keep their model alive until they finish.
+        if not self.memory_cap_mb:
+            return
+        while sum(size for _, size in self._models.values()) > self.memory_cap_mb:
+            victim = next((n for n in self._models if n not in (keep, self.default_model)), None)
+            if victim is None:
+                break
+            del self._models[victim]
+            self.states[victim] = "evicted"
+            self.evictions += 1
+            log.info("Evicted model %s to stay under %s MB", victim, self.memory_cap_mb)
+
+    def stats(self) -> dict:
+        return {
+            "default": self.default_model,
+            "loaded": list(self._models),
+            "states": dict(self.states),
+            "load_times_sec": dict(self.load_times),
+            "memory_mb": round(sum(size for _, size in self._models.values()), 1),
+            "memory_cap_mb": self.memory_cap_mb,
+            "evictions": self.evictions,
+        }
+
+
+def _dir_size_mb(path: str) -> float:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total / (1024 * 1024)
@@ -0,0 +1,161 @@
+"""
+Background persistence of transcription sessions and results.
+
+Handlers enqueue rows and return immediately; a single writer task inserts
+them in batches on a worker thread, so database latency never adds to
+transcription latency.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+import metrics
+from database import SessionLocal, TranscriptionSession, TranscriptionResult
+
+log = logging.getLogger(__name__)
+
+
+class TranscriptWriter:
+    def __init__(self, batch_size: int = 200, flush_interval: float = 1.0, max_queue: int = 10000):
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self._queue = None
+        self._task = None
+        self._done = None
+        self._enqueued = 0
+        self._processed = 0
+        # Stats
+        self.rows_written = 0
+        self.batches_written = 0
+        self.failed_batches = 0
+        self.dropped = 0
+        self.last_batch_ms = 0.0
+        self.last_lag_ms = 0.0
+        self.max_lag_ms = 0.0
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._done = asyncio.Condition()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write everything still queued, then stop the writer."""
+        if self._task is None:
+            return
+        await self.flush()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def add_session(self, session_id: str, user_token: str):
+        now = datetime.utcnow()
+        self._put(TranscriptionSession, {"session_id": session_id, "user_token": user_token,
+                                         "created_at": now, "updated_at": now})
+
+    def add_result(self, session_id: str, text: str, audio_duration: int = None, confidence: str = None):
+        self._put(TranscriptionResult, {
+            "session_id": session_id,
+            "text": text,
+            "audio_duration": audio_duration,
+            "confidence": confidence,
+            "timestamp": datetime.utcnow(),  # when the text was produced, not when it was written
+        })
+
+    def _put(self, model, row: dict):
+        if self._task is None:
+            self.start()
+        if self.queue_depth() >= self.max_queue:
+            self.dropped += 1
+            return
+        self._enqueued += 1
+        self._queue.put_nowait((time.perf_counter(), model, row))
+
+    async def flush(self):
+        """Write every row queued so far right away and wait for it to land."""
+        if self._task is None or self._processed >= self._enqueued:
+            return
+        target = self._enqueued
+        # Wake the writer so it doesn't wait out flush_interval
+        self._queue.put_nowait(None)
+        async with self._done:
+            await self._done.wait_for(lambda: self._processed >= target)
+
+    def queue_depth(self) -> int:
+        return self._enqueued - self._processed
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                continue
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:  # flush requested
+                    break
+                batch.append(item)
+
+            started = time.perf_counter()
+            try:
+                await loop.run_in_executor(None, self._write, batch)
+                self.rows_written += len(batch)
+                self.batches_written += 1
+            except Exception as e:
+                self.failed_batches += 1
+                metrics.DB_FAILED_BATCHES.inc()
+                log.error("Failed to write %d rows: %s", len(batch), e)
+            finished = time.perf_counter()
+            self.last_batch_ms = (finished - started) * 1000
+            self.last_lag_ms = (finished - batch[0][0]) * 1000
+            self.max_lag_ms = max(self.max_lag_ms, self.last_lag_ms)
+            metrics.DB_WRITE_LAG_SECONDS.observe(finished - batch[0][0])
+            async with self._done:
+                self._processed += len(batch)
+                self._done.notify_all()
+
+    @staticmethod
+    def _write(batch: list):
+        # Group rows per table, sessions first so results never precede their session
+        tables = {TranscriptionSession: [], TranscriptionResult: []}
+        for _, model, row in batch:
+            tables[model].append(row)
+        db = SessionLocal()
+        try:
+            for model, rows in tables.items():
+                if rows:
+                    db.execute(insert(model), rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "rows_written": self.rows_written,
+            "batches_written": self.batches_written,
+            "failed_batches": self.failed_batches,
+            "dropped": self.dropped,
+            "last_batch_ms": round(self.last_batch_ms, 1),
+            "last_lag_ms": round(self.last_lag_ms, 1),
+            "max_lag_ms": round(self.max_lag_ms, 1),
+        }
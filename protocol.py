@@ -0,0 +1,138 @@
+"""
+Binary framing for /ws-pcm16 (opt in with ``?protocol=1``).
+
+Every client message is a frame: a fixed 10-byte header followed by the
+payload. All fields are big-endian.
+
+    version      u8   PROTOCOL_VERSION
+    type         u8   AUDIO, CONTROL or ACK
+    codec        u8   PCM16, MULAW, OPUS or F32 (audio frames)
+    flags        u8   reserved, 0
+    seq          u32  audio frame sequence number, increasing by one per frame
+    sample_rate  u16  rate the payload was captured at, in Hz
+
+Audio payloads are 16-bit little-endian PCM, 8-bit G.711 mu-law, 32-bit
+little-endian float PCM, or one raw Opus packet (no container). PCM at any
+rate, interleaved with the channel count negotiated for the connection, is
+resampled and downmixed on the server. Control payloads are the UTF-8
+commands the text protocol uses (``flush``, ``bye``). The server acknowledges buffered audio
+with header-only ACK frames carrying the highest sequence number received,
+which is where a resumed session picks up.
+"""
+import collections
+import struct
+
+import av
+import numpy as np
+
+from audio import PCM16_SCALE, StreamingResampler
+
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct("!BBBBIH")
+
+# Frame types
+AUDIO = 1
+CONTROL = 2
+ACK = 3
+
+# Audio codecs
+PCM16 = 0
+MULAW = 1
+OPUS = 2
+F32 = 3
+CODEC_NAMES = {PCM16: "pcm16", MULAW: "mulaw", OPUS: "opus", F32: "f32"}
+
+# Accepted input sample rates for PCM audio
+MIN_RATE = 8000
+MAX_RATE = 48000
+
+Frame = collections.namedtuple("Frame", "type codec flags seq sample_rate payload")
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def parse_frame(data: bytes) -> Frame:
+    if len(data) < HEADER.size:
+        raise ProtocolError(f"frame of {len(data)} bytes is shorter than the {HEADER.size}-byte header")
+    version, kind, codec, flags, seq, sample_rate = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"unsupported protocol version {version}")
+    if kind not in (AUDIO, CONTROL):
+        raise ProtocolError(f"unexpected frame type {kind}")
+    return Frame(kind, codec, flags, seq, sample_rate, memoryview(data)[HEADER.size:])
+
+
+def build_frame(kind: int, seq: int = 0, codec: int = 0, sample_rate: int = 0, payload: bytes = b"") -> bytes:
+    return HEADER.pack(PROTOCOL_VERSION, kind, codec, 0, seq, sample_rate) + payload
+
+
+def _mulaw_table() -> np.ndarray:
+    # G.711 mu-law expansion for all 256 code words
+    codes = ~np.arange(256, dtype=np.uint8)
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = (((mantissa.astype(np.int32) << 3) + 0x84) << exponent) - 0x84
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+
+MULAW_TABLE = _mulaw_table()
+
+
+class FrameDecoder:
+    """Turns audio frame payloads into float32 mono samples at the server's sample rate.
+
+    Holds codec and resampler state for one session (the Opus decoder and the
+    resampling filter carry state from frame to frame), so it lives as long
+    as the session, not the connection.
+    """
+
+    def __init__(self, sample_rate: int = 16000, channels: int = 1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self._pcm = None     # StreamingResampler for the current PCM input rate
+        self._opus = None
+        self._opus_resampler = None
+
+    def decode(self, frame: Frame) -> np.ndarray:
+        if frame.codec == OPUS:
+            return self._decode_opus(frame.payload)
+        if frame.codec == PCM16:
+            if len(frame.payload) % 2:
+                raise ProtocolError("pcm16 payload has an odd number of bytes")
+            samples, scale = np.frombuffer(frame.payload, dtype="<i2"), PCM16_SCALE
+        elif frame.codec == MULAW:
+            samples, scale = MULAW_TABLE[np.frombuffer(frame.payload, dtype=np.uint8)], PCM16_SCALE
+        elif frame.codec == F32:
+            if len(frame.payload) % 4:
+                raise ProtocolError("f32 payload is not a whole number of samples")
+            samples, scale = np.frombuffer(frame.payload, dtype="<f4"), 1.0
+        else:
+            raise ProtocolError(f"unknown codec {frame.codec}")
+        return self._resampler(frame.sample_rate).process(samples, scale)
+
+    def _resampler(self, rate: int) -> StreamingResampler:
+        if not MIN_RATE <= rate <= MAX_RATE:
+            raise ProtocolError(f"unsupported sample rate {rate}")
+        if self._pcm is None or self._pcm.in_rate != rate:
+            self._pcm = StreamingResampler(rate, self.sample_rate, self.channels)
+        return self._pcm
+
+    def _decode_opus(self, packet: bytes) -> np.ndarray:
+        if self._opus is None:
+            self._opus = av.CodecContext.create("opus", "r")
+            # Without a layout the decoder assumes stereo, and downmixing that doubled mono adds 3 dB
+            layout = "mono" if self.channels == 1 else "stereo"
+            self._opus.layout = layout
+            self._opus.sample_rate = 48000
+            # Packed float at the decoded layout; channels are averaged below, as for PCM input
+            self._opus_resampler = av.audio.resampler.AudioResampler(format="flt", layout=layout, rate=self.sample_rate)
+        try:
+            frames = self._opus.decode(av.Packet(bytes(packet)))
+        except av.error.FFmpegError as e:
+            raise ProtocolError(f"bad opus packet: {e}")
+        channels = self._opus.channels
+        out = [f.to_ndarray().reshape(-1, channels).mean(axis=1, dtype=np.float32)
+               for frame in frames for f in self._opus_resampler.resample(frame)]
+        return np.concatenate(out) if out else np.zeros(0, dtype=np.float32)
@@ -0,0 +1,424 @@
+"""
+Inference scheduler for Whisper decodes.
+
+Decodes are CPU-bound and must never run on the event loop. Jobs are queued
+per session and served round-robin by a fixed number of dispatcher tasks,
+each of which hands its job to a thread (or process) pool, or to the shared
+inference process (see inference_server.py).
+"""
+import asyncio
+import collections
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class SchedulerFull(Exception):
+    """Raised when the inference queue is at capacity."""
+
+
+class InferenceJob:
+    def __init__(self, session_id: str, fn, args: tuple, future: asyncio.Future, kind: str = "stream"):
+        self.session_id = session_id
+        self.kind = kind  # "stream" for streaming sessions, "file" for uploads
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.result = None
+        self.submitted_at = time.perf_counter()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def queue_wait(self) -> float:
+        """Seconds spent waiting in the queue."""
+        end = self.started_at if self.started_at is not None else time.perf_counter()
+        return end - self.submitted_at
+
+    @property
+    def run_time(self) -> float:
+        """Seconds spent executing on the pool."""
+        if self.started_at is None:
+            return 0.0
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started_at
+
+
+def _pool_ready() -> bool:
+    return True
+
+
+class InferenceScheduler:
+    LOAD_WINDOW = 10.0  # seconds of history behind load()
+
+    def __init__(self, workers: int = 1, max_queue: int = 32, executor: str = "thread",
+                 remote_address: str = None, authkey: bytes = None, shm_slots: int = 8,
+                 initializer=None, initargs: tuple = ()):
+        if executor not in ("thread", "process", "remote"):
+            raise ValueError(f"Unknown executor type: {executor}")
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self.executor = executor
+        self.remote_address = remote_address  # inference process socket, for executor="remote"
+        self._authkey = authkey
+        self.shm_slots = shm_slots  # shared memory audio slots, for executor="remote"
+        self.initializer = initializer  # runs once in each pool process, for executor="process"
+        self.initargs = initargs
+        # session_id -> deque of pending jobs; order of keys is the round-robin order
+        self._queues = collections.OrderedDict()
+        self._pending = 0
+        self._running = 0
+        self._pool = None
+        self._tasks = []
+        self._wakeup = None
+        self._recent = collections.deque()  # (finished_at, run_time, kind) within LOAD_WINDOW
+        self._active = collections.Counter()  # kind -> jobs queued or running
+        self._started_at = time.perf_counter()
+        # Aggregate stats
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_queue_wait = 0.0
+        self.total_run_time = 0.0
+        self.last_queue_wait = 0.0
+        self.last_run_time = 0.0
+
+    @property
+    def started(self) -> bool:
+        return self._pool is not None
+
+    def start(self):
+        if self.started:
+            return
+        if self.executor == "process":
+            # spawn, not fork: CTranslate2 threads do not survive a fork
+            self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=self.initializer, initargs=self.initargs)
+        elif self.executor == "remote":
+            from inference_server import connect
+            self._pool = connect(self.remote_address, self._authkey, self.shm_slots)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def warm_up(self):
+        """Start every pool process now, so the initializer runs before the first decode rather than inside it."""
+        if self.executor != "process":
+            return
+        loop = asyncio.get_running_loop()
+        # Processes are spawned on demand, one per job submitted while the others are busy
+        await asyncio.gather(*(loop.run_in_executor(self._pool, _pool_ready) for _ in range(self.workers)))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        for jobs in self._queues.values():
+            for job in jobs:
+                if not job.future.done():
+                    job.future.cancel()
+        self._queues.clear()
+        self._pending = 0
+        self._active.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def queue_depth(self) -> int:
+        return self._pending
+
+    def load(self, kind: str = None) -> float:
+        """Fraction of worker capacity in use over the last LOAD_WINDOW seconds.
+
+        Counts finished run time plus the estimated cost of everything still
+        queued, so a growing backlog reads as load above 1.0 before it shows
+        up as latency. With kind, only jobs submitted with that kind count.
+        """
+        now = time.perf_counter()
+        while self._recent and self._recent[0][0] < now - self.LOAD_WINDOW:
+            self._recent.popleft()
+        window = max(1.0, min(self.LOAD_WINDOW, now - self._started_at))
+        busy = sum(run for _, run, k in self._recent if kind is None or k == kind)
+        outstanding = self._pending + self._running if kind is None else self._active[kind]
+        avg_run = self.total_run_time / self.completed if self.completed else 0.0
+        return (busy + outstanding * avg_run) / (window * self.workers)
+
+    async def submit(self, session_id: str, fn, *args, kind: str = "stream") -> InferenceJob:
+        """Queue fn(*args) for session_id and wait for it to finish.
+
+        Returns the completed InferenceJob; its result is in ``job.result``.
+        Raises SchedulerFull if the queue is at capacity.
+        """
+        if not self.started:
+            self.start()
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerFull(f"Inference queue full ({self._pending}/{self.max_queue})")
+
+        job = InferenceJob(session_id, fn, args, asyncio.get_running_loop().create_future(), kind)
+        self._queues.setdefault(session_id, collections.deque()).append(job)
+        self._pending += 1
+        self._active[kind] += 1
+        self._wakeup.set()
+        try:
+            await job.future
+        except asyncio.CancelledError:
+            # Caller went away (e.g. client disconnected); drop the job if it hasn't started
+            self._discard(job)
+            raise
+        return job
+
+    def _discard(self, job: InferenceJob):
+        jobs = self._queues.get(job.session_id)
+        if jobs and job in jobs:
+            jobs.remove(job)
+            self._pending -= 1
+            self._active[job.kind] -= 1
+            if not jobs:
+                del self._queues[job.session_id]
+
+    def _next_job(self) -> InferenceJob:
+        # Take the head job of the first session, then rotate that session to the back
+        session_id, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        del self._queues[session_id]
+        if jobs:
+            self._queues[session_id] = jobs
+        self._pending -= 1
+        return job
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self._queues:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            job = self._next_job()
+            if job.future.done():
+                self._active[job.kind] -= 1
+                continue
+
+            job.started_at = time.perf_counter()
+            self._running += 1
+            try:
+                job.result = await loop.run_in_executor(self._pool, job.fn, *job.args)
+            except Exception as e:
+                job.finished_at = time.perf_counter()
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+                continue
+            finally:
+                self._running -= 1
+                self._active[job.kind] -= 1
+
+            job.finished_at = time.perf_counter()
+            self.completed += 1
+            self.last_queue_wait = job.queue_wait
+            self.last_run_time = job.run_time
+            self.total_queue_wait += job.queue_wait
+            self.total_run_time += job.run_time
+            self._recent.append((job.finished_at, job.run_time, job.kind))
+            if not job.future.done():
+                job.future.set_result(job)
+
+    def stats(self) -> dict:
+        done = max(1, self.completed)
+        return {
+            "executor": self.executor,
+            "workers": self.workers,
+            "queue_depth": self._pending,
+            "queue_capacity": self.max_queue,
+            "running": self._running,
+            "sessions_waiting": len(self._queues),
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "last_queue_wait_ms": round(self.last_queue_wait * 1000, 1),
+            "last_run_time_ms": round(self.last_run_time * 1000, 1),
+            "avg_queue_wait_ms": round(self.total_queue_wait / done * 1000, 1),
+            "avg_run_time_ms": round(self.total_run_time / done * 1000, 1),
+            "load": round(self.load(), 2),
+        }
+
+
+class AdmissionController:
+    """Caps concurrent streaming sessions by count and by projected inference load.
+
+    The cost of one session is the scheduler's load from streaming jobs
+    (uploads don't count) divided by the average number of sessions open over
+    the same window, so sessions that just left still count for the load they
+    caused. One more session projects to
+    cost * (n + 1); new sessions are admitted while that stays at or under
+    ``max_load``, otherwise they wait up to ``wait`` seconds for capacity and
+    are then refused.
+    """
+
+    def __init__(self, scheduler: InferenceScheduler, max_sessions: int = 0, max_load: float = 1.0,
+                 wait: float = 0.0):
+        self.scheduler = scheduler
+        self.max_sessions = max_sessions   # 0 means no cap
+        self.max_load = max_load           # 0 disables the load check
+        self.wait = wait
+        self.sessions = 0
+        self._released = None
+        self._history = collections.deque([(time.perf_counter(), 0)])  # (time, sessions) at each change
+        # Stats
+        self.admitted = 0
+        self.refused = 0
+
+    def projected_load(self) -> float:
+        load = self.scheduler.load("stream")
+        sessions = self._average_sessions()
+        return load / sessions * (self.sessions + 1) if sessions >= 1 else load
+
+    def _average_sessions(self) -> float:
+        # Time-weighted mean of open sessions over the scheduler's load window
+        now = time.perf_counter()
+        since = now - self.scheduler.LOAD_WINDOW
+        while len(self._history) > 1 and self._history[1][0] <= since:
+            self._history.popleft()
+        total = 0.0
+        start = max(since, self._history[0][0])
+        for (t, count), nxt in zip(self._history, list(self._history)[1:] + [(now, None)]):
+            total += count * (nxt[0] - max(t, start))
+        return total / max(1e-6, now - start)
+
+    def _set_sessions(self, sessions: int):
+        self.sessions = sessions
+        self._history.append((time.perf_counter(), sessions))
+
+    def _check(self) -> str:
+        if self.max_sessions and self.sessions >= self.max_sessions:
+            return f"session limit reached ({self.sessions}/{self.max_sessions})"
+        if self.max_load and self.sessions and self.projected_load() > self.max_load:
+            return f"inference overloaded (projected load {self.projected_load():.2f})"
+        return None
+
+    async def acquire(self) -> str:
+        """Take a session slot. Returns None when admitted, otherwise the reason for refusal."""
+        if self._released is None:
+            self._released = asyncio.Condition()
+        deadline = time.perf_counter() + self.wait
+        reason = self._check()
+        while reason and time.perf_counter() < deadline:
+            # Load also drops without a release as finished decodes age out, so re-check periodically
+            async with self._released:
+                try:
+                    await asyncio.wait_for(self._released.wait(), min(0.5, deadline - time.perf_counter()))
+                except asyncio.TimeoutError:
+                    pass
+            reason = self._check()
+        if reason:
+            self.refused += 1
+            return reason
+        self._set_sessions(self.sessions + 1)
+        self.admitted += 1
+        return None
+
+    async def release(self):
+        self._set_sessions(self.sessions - 1)
+        if self._released is not None:
+            async with self._released:
+                self._released.notify()
+
+    def stats(self) -> dict:
+        return {
+            "sessions": self.sessions,
+            "max_sessions": self.max_sessions,
+            "max_load": self.max_load,
+            "projected_load": round(self.projected_load(), 2),
+            "admitted": self.admitted,
+            "refused": self.refused,
+        }
+
+
+class MicroBatcher:
+    """Collects windows from many sessions and decodes them as one batch.
+
+    The first window to arrive opens a batch; it is flushed once ``max_batch``
+    windows are pending or ``max_wait`` seconds have passed, whichever comes
+    first. The batch runs as a single job on the scheduler and each caller
+    gets back its own result. ``on_batch(job, batch_size)``, if given, runs
+    once per finished batch (callers all share the job, so per-job accounting
+    belongs there rather than with each caller).
+    """
+
+    def __init__(self, scheduler: InferenceScheduler, batch_fn, max_batch: int = 8, max_wait: float = 0.1,
+                 on_batch=None):
+        self.scheduler = scheduler
+        self.batch_fn = batch_fn
+        self.on_batch = on_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait)
+        self._pending = []  # (session_id, item, future)
+        self._timer = None
+        self._batch_seq = 0
+        self._tasks = set()  # keep running batch tasks referenced
+        # Stats
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+
+    async def submit(self, session_id: str, item):
+        """Add item to the next batch and wait for its result.
+
+        Returns (result, job, batch_size) where job is the scheduler job the
+        batch ran as.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((session_id, item, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Drop callers that have gone away before we spend a decode on them
+        batch = [entry for entry in self._pending if not entry[2].done()]
+        self._pending = []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        self._batch_seq += 1
+        items = [item for _, item, _ in batch]
+        try:
+            job = await self.scheduler.submit(f"batch-{self._batch_seq}", self.batch_fn, items)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += len(batch)
+        self.last_batch_size = len(batch)
+        if self.on_batch is not None:
+            self.on_batch(job, len(batch))
+        for (_, _, future), result in zip(batch, job.result):
+            if not future.done():
+                future.set_result((result, job, len(batch)))
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "avg_batch_size": round(self.items / max(1, self.batches), 2),
+            "last_batch_size": self.last_batch_size,
+        }
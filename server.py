@@ -1,25 +1,86 @@
-import asyncio, io, time, collections, os, uuid
-import av, numpy as np
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Depends
+import asyncio, collections, functools, json, logging, time, os, types, uuid
+import numpy as np
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from jose import jwt, JWTError
-from faster_whisper import WhisperModel
-from sqlalchemy.orm import Session
-from database import get_db, create_tables, TranscriptionSession, TranscriptionResult
+from faster_whisper.tokenizer import Tokenizer
+import ctranslate2
+from audio import PCM16_SCALE, AudioRingBuffer, StreamingAudioDecoder, StreamingResampler, VoiceActivityDetector, decode_audio_file, split_on_silence
+from streaming import EmitScheduler, IncrementalTranscriber, LagMonitor, SpeculativeTranscriber, WordTimeline
+from database import create_tables, check_connection
+from persistence import TranscriptWriter
+from cache import TranscriptCache
+from protocol import ACK, CONTROL, MAX_RATE, MIN_RATE, PROTOCOL_VERSION, FrameDecoder, ProtocolError, build_frame, parse_frame
+from sessions import SessionSocket, SessionStore
+from model_registry import ModelRegistry, ModelNotAllowed
+from inference_server import RemoteModelRegistry
+import metrics
+from scheduler import AdmissionController, InferenceScheduler, MicroBatcher, SchedulerFull
 
 # ---- Config ----
 SECRET = os.getenv("SECRET_KEY", "1ZCsvqyHdDd7mK8wr5pkTmLYvvB5DtKm")
 ALGO = "HS256"
 LANG = os.getenv("WHISPER_LANG", "en")
 MODEL_NAME = os.getenv("MODEL_NAME", "small.en")       # try base.en for even lower latency
+PARTIAL_MODEL = os.getenv("PARTIAL_MODEL", "base.en")  # fast model for partials in speculative mode
+ALLOWED_MODELS = [m.strip() for m in os.getenv("ALLOWED_MODELS", MODEL_NAME).split(",") if m.strip()]  # selectable with ?model=
+PRELOAD_MODELS = [m.strip() for m in os.getenv("PRELOAD_MODELS", "").split(",") if m.strip()]          # loaded at startup besides MODEL_NAME
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR") or None     # local directory for downloaded/converted models
+MODEL_MEMORY_MB = float(os.getenv("MODEL_MEMORY_MB", "0"))  # approximate cap for loaded models, 0 = unlimited
 COMPUTE_TYPE = os.getenv("COMPUTE_TYPE", "int8")         # int8 for CPU
 CHUNK_WINDOW_SEC = float(os.getenv("CHUNK_WINDOW_SEC", "10.0"))       # longer rolling window for better context
 CHUNK_OVERLAP_SEC = float(os.getenv("CHUNK_OVERLAP_SEC", "2.0"))       # longer overlap to reduce word cuts
 SAMPLE_RATE = int(os.getenv("SAMPLE_RATE", "16000"))           # we'll decode to mono 16k
 PORT = int(os.getenv("PORT", "8000"))
 HOST = os.getenv("HOST", "0.0.0.0")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))          # concurrent decodes
+INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "32"))   # max pending decodes across all sessions
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "thread")        # "thread", "process" (one model copy per process) or "remote" (shared inference process)
+INFERENCE_ADDRESS = os.getenv("INFERENCE_ADDRESS", "/tmp/whisper-inference.sock")  # socket of the shared inference process
+INFERENCE_CPU_THREADS = int(os.getenv("INFERENCE_CPU_THREADS", "0"))  # CTranslate2 intra_threads per decode, 0 = library default
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))                # streaming windows per batched decode, 1 disables batching
+# Shared memory audio slots (30s each) per web worker with the remote executor; by default one per window that can be in flight
+INFERENCE_SHM_SLOTS = int(os.getenv("INFERENCE_SHM_SLOTS", str(max(1, INFERENCE_WORKERS) * max(1, BATCH_MAX_SIZE))))
+BATCH_WAIT_MS = float(os.getenv("BATCH_WAIT_MS", "100"))              # how long the first window waits for others to join
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "0"))                    # concurrent streaming sessions, 0 = no cap
+ADMISSION_MAX_LOAD = float(os.getenv("ADMISSION_MAX_LOAD", "1.0"))    # refuse sessions when projected worker load exceeds this, 0 disables
+ADMISSION_WAIT_SEC = float(os.getenv("ADMISSION_WAIT_SEC", "0"))      # how long a new session waits for capacity before being refused
+LAG_DEGRADE_SEC = float(os.getenv("LAG_DEGRADE_SEC", "3.0"))          # decode latency that tells a client to degrade, 0 disables
+EMIT_TARGET_SEC_WS = float(os.getenv("EMIT_TARGET_SEC_WS", "1.5"))    # latency target from audio in to text out on /ws
+EMIT_TARGET_SEC_PCM16 = float(os.getenv("EMIT_TARGET_SEC_PCM16", "2.5"))  # same for /ws-pcm16
+EMIT_MIN_INTERVAL_SEC = float(os.getenv("EMIT_MIN_INTERVAL_SEC", "0.5"))  # fastest decode cadence, used when idle
+EMIT_MAX_INTERVAL_SEC = float(os.getenv("EMIT_MAX_INTERVAL_SEC", "8.0"))  # slowest decode cadence under load
+EMIT_TARGET_LOAD = float(os.getenv("EMIT_TARGET_LOAD", "0.7"))        # inference load sessions pace themselves towards
+EMIT_MIN_WINDOW_SEC = float(os.getenv("EMIT_MIN_WINDOW_SEC", "4.0"))  # smallest window mode window under load
+SESSION_GRACE_SEC = float(os.getenv("SESSION_GRACE_SEC", "30"))      # how long a dropped framed /ws-pcm16 session can be resumed, 0 disables
+SESSION_PENDING_MAX = 100                                             # results kept for a dropped connection
+WS_CLOSE_TRY_AGAIN = 1013                                             # standard "try again later" close code
+WS_CLOSE_BAD_AUDIO = 1003                                             # standard "unsupported data" close code
+STREAMING_MODE = os.getenv("STREAMING_MODE", "window")                # "window" (re-decode rolling window), "incremental" or "speculative"
+# Modes clients may pick with ?mode=; speculative is opt-in because it keeps PARTIAL_MODEL loaded as well
+STREAMING_MODES = [m.strip() for m in os.getenv("STREAMING_MODES", f"window,incremental,{STREAMING_MODE}").split(",") if m.strip()]
+PARTIAL_INTERVAL_SEC = float(os.getenv("PARTIAL_INTERVAL_SEC", "0.5"))  # new audio between fast-model partials in speculative mode
+MIN_CHUNK_SEC = float(os.getenv("MIN_CHUNK_SEC", "1.0"))              # new audio needed before the next incremental decode
+VAD_ENABLED = os.getenv("VAD_ENABLED", "1") == "1"                  # gate inference on server-side voice activity
+VAD_THRESHOLD_DB = float(os.getenv("VAD_THRESHOLD_DB", "10.0"))       # frame energy above noise floor that counts as speech
+VAD_SILENCE_MS = int(os.getenv("VAD_SILENCE_MS", "600"))              # silence that ends an utterance
+VAD_PADDING_SAMPLES = int(0.2 * SAMPLE_RATE)                          # audio kept around speech boundaries
+IDLE_FLUSH_SEC = float(os.getenv("IDLE_FLUSH_SEC", str(VAD_SILENCE_MS / 1000)))  # no audio for this long finalises the tail (incremental/speculative)
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "200"))               # rows per bulk insert
+DB_FLUSH_INTERVAL = float(os.getenv("DB_FLUSH_INTERVAL", "1.0"))      # max seconds a result waits before being written
+FILE_CHUNK_SEC = float(os.getenv("FILE_CHUNK_SEC", "30.0"))          # max chunk length for /transcribe uploads
+CACHE_MEMORY_MB = float(os.getenv("CACHE_MEMORY_MB", "64"))          # in-memory transcription cache, 0 disables
+CACHE_DIR = os.getenv("CACHE_DIR") or None                             # on-disk cache tier, unset disables
+CACHE_DISK_MB = float(os.getenv("CACHE_DISK_MB", "1024"))             # size cap for the on-disk tier
+NO_SPEECH_THRESHOLD = 0.6
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+log = logging.getLogger("whisper.server")
+# Hot-path logging is guarded by this flag so nothing is formatted unless debugging
+DEBUG = log.isEnabledFor(logging.DEBUG)
 
 app = FastAPI(title="Whisper WebSocket Server", version="1.0.0")
 
@@ -42,7 +103,62 @@ app.add_middleware(
 @app.on_event("startup")
 async def startup_event():
     create_tables()
-    print("Database tables created/verified")
+    log.info("Database tables created/verified")
+    scheduler.start()
+    log.info("Inference scheduler started executor=%s workers=%d", INFERENCE_EXECUTOR, INFERENCE_WORKERS)
+    writer.start()
+    # Load models after the server is listening so liveness checks pass immediately
+    global preload_task
+    preload_task = asyncio.create_task(preload_models())
+
+def startup_models() -> list:
+    # PARTIAL_MODEL only where speculative sessions can happen, so the first doesn't wait for a download
+    speculative = STREAMING_MODE == "speculative" or "speculative" in STREAMING_MODES
+    return [MODEL_NAME] + PRELOAD_MODELS + ([PARTIAL_MODEL] if speculative else [])
+
+def streaming_mode(params) -> str:
+    mode = params.get("mode", STREAMING_MODE)
+    if mode != STREAMING_MODE and mode not in STREAMING_MODES:
+        raise ValueError(f"streaming mode {mode!r} is not enabled")
+    return mode
+
+async def preload_models():
+    global pool_ready
+    if INFERENCE_EXECUTOR == "process":
+        # Decodes run in the pool processes, each with its own models (load_pool_models); none are needed here
+        try:
+            await scheduler.warm_up()
+            pool_ready = True
+        except Exception as e:
+            log.error("Failed to start inference processes: %s", e)
+        return
+    for name in startup_models():
+        try:
+            await registry.ensure_loaded(name)
+        except Exception as e:
+            log.error("Failed to load model %s: %s", name, e)
+
+def load_pool_models(names: list):
+    # Initializer of each INFERENCE_EXECUTOR=process pool process: load and warm up before the first decode
+    for name in names:
+        try:
+            registry.get(name)
+        except Exception as e:
+            log.error("Failed to load model %s: %s", name, e)
+
+async def ensure_model(name: str):
+    # In process mode models are loaded by the pool processes themselves
+    if INFERENCE_EXECUTOR != "process":
+        await registry.ensure_loaded(name)
+
+def models_ready() -> bool:
+    return pool_ready if INFERENCE_EXECUTOR == "process" else registry.is_ready()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    # Don't lose results that are still queued for the database
+    await writer.stop()
 
 # Mount static files for the frontend
 if os.path.exists("static"):
@@ -56,26 +172,68 @@ async def read_root():
     else:
         return {"message": "Whisper WebSocket Server", "endpoints": {"/ws": "WebSocket for streaming transcription", "/ws-pcm16": "WebSocket for PCM16 audio", "/transcribe": "HTTP file upload"}}
 
-# Health check endpoint for Railway
+# Liveness: the process is up and serving requests
 @app.get("/health")
-async def health_check(db: Session = Depends(get_db)):
+async def health_check():
     try:
-        # Test database connection
-        db.execute("SELECT 1")
+        # Test database connection without blocking the event loop
+        await asyncio.to_thread(check_connection)
         db_status = "connected"
     except Exception as e:
         db_status = f"error: {str(e)}"
     
     return {
         "status": "healthy", 
+        "ready": models_ready(),
         "model": MODEL_NAME, 
+        "models": registry.stats(),
         "database": db_status,
+        "inference": scheduler.stats(),
+        "admission": admission.stats(),
+        "batching": {name: b.stats() for name, b in batchers.items()},
+        "persistence": writer.stats(),
+        "cache": cache.stats(),
+        "sessions": sessions.stats(),
         "environment": os.getenv("RAILWAY_ENVIRONMENT", "local")
     }
 
-print("Loading model...")
-model = WhisperModel(MODEL_NAME, device="cpu", compute_type=COMPUTE_TYPE)
-print("Model ready.")
+# Readiness for Railway's deploy health check: the default model is loaded and warmed up
+@app.get("/ready")
+async def readiness_check():
+    if not models_ready():
+        return JSONResponse(status_code=503, content={"status": "loading", "models": registry.stats()["states"]})
+    return {"status": "ready", "model": MODEL_NAME}
+
+# Prometheus scrape endpoint; queue gauges are sampled at scrape time
+@app.get("/metrics")
+async def metrics_endpoint():
+    metrics.INFERENCE_QUEUE_DEPTH.set(scheduler.queue_depth())
+    metrics.INFERENCE_LOAD.set(scheduler.load())
+    metrics.DB_QUEUE_DEPTH.set(writer.queue_depth())
+    content, content_type = metrics.render()
+    return Response(content, headers={"Content-Type": content_type})
+
+# Preloaded models and PARTIAL_MODEL may be loaded, but only ALLOWED_MODELS can be picked with ?model=
+if INFERENCE_EXECUTOR == "remote":
+    # Models live in the shared inference process; this worker only validates names and tracks readiness
+    registry = RemoteModelRegistry(INFERENCE_ADDRESS, SECRET.encode(), MODEL_NAME, ALLOWED_MODELS,
+                                   PRELOAD_MODELS + [PARTIAL_MODEL])
+else:
+    registry = ModelRegistry(MODEL_NAME, ALLOWED_MODELS, PRELOAD_MODELS + [PARTIAL_MODEL], compute_type=COMPUTE_TYPE,
+                             num_workers=INFERENCE_WORKERS, cache_dir=MODEL_CACHE_DIR, memory_cap_mb=MODEL_MEMORY_MB,
+                             cpu_threads=INFERENCE_CPU_THREADS)
+preload_task = None
+pool_ready = False  # INFERENCE_EXECUTOR=process: every pool process has loaded its models
+
+scheduler = InferenceScheduler(workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE_SIZE, executor=INFERENCE_EXECUTOR,
+                               remote_address=INFERENCE_ADDRESS, authkey=SECRET.encode(), shm_slots=INFERENCE_SHM_SLOTS,
+                               initializer=load_pool_models, initargs=(startup_models(),))
+writer = TranscriptWriter(batch_size=DB_BATCH_SIZE, flush_interval=DB_FLUSH_INTERVAL)
+admission = AdmissionController(scheduler, max_sessions=MAX_SESSIONS, max_load=ADMISSION_MAX_LOAD, wait=ADMISSION_WAIT_SEC)
+session_lag = {}  # session id -> LagMonitor for open streaming sessions
+session_emit = {}  # session id -> EmitScheduler for open streaming sessions
+sessions = SessionStore(grace_sec=SESSION_GRACE_SEC)
+cache = TranscriptCache(memory_mb=CACHE_MEMORY_MB, disk_dir=CACHE_DIR, disk_mb=CACHE_DISK_MB)
 
 def verify(token: str):
     try:
@@ -83,224 +241,576 @@ def verify(token: str):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-def opus_webm_to_pcm16_mono16k(raw_bytes: bytes) -> bytes:
+def decode_audio(audio_np: np.ndarray, model_name: str = None) -> str:
+    # Blocking decode; runs on the inference pool, never on the event loop.
+    # audio_np is float32 mono in [-1.0, 1.0] at SAMPLE_RATE, straight from the ring buffer
+    model = registry.get(model_name)
+
+    # Now transcribe directly with the numpy array - much faster!
+    segments, info = model.transcribe(
+        audio_np,  # Pass numpy array directly instead of file path
+        language=LANG,
+        task="transcribe",
+        beam_size=1,  # Fastest beam size
+        vad_filter=True,  # Enable VAD to filter silence
+        word_timestamps=False,
+        initial_prompt=None,
+        no_speech_threshold=NO_SPEECH_THRESHOLD,  # Higher threshold to reduce false positives
+        condition_on_previous_text=False  # Don't condition on previous text for streaming
+    )
+
+    segment_texts = []
+    # segments is a lazy generator: the actual decoding happens while iterating
+    for i, segment in enumerate(segments):
+        # Filter out very short segments that might be noise
+        if len(segment.text.strip()) > 1:
+            if DEBUG:
+                log.debug("segment %d %.2f-%.2fs %r", i, segment.start, segment.end, segment.text)
+            segment_texts.append(segment.text)
+
+    text = " ".join(segment_texts)  # Use space to join segments
+    return text.strip()
+
+def decode_batch(windows: list, model_name: str = None) -> list:
+    # Batched decode of several streaming windows (each <= 30s) in one encoder/decoder pass.
+    # Windows are padded to Whisper's fixed 30s input, so N windows cost one batched
+    # forward pass instead of N separate ones.
+    model = registry.get(model_name)
+    fe = model.feature_extractor
+    features = []
+    for audio_np in windows:
+        mel = fe(audio_np)
+        if mel.shape[1] > fe.nb_max_frames:
+            # Only the first 30s fit in the encoder; keep CHUNK_WINDOW_SEC at 30 or less when batching
+            log.warning("batched window of %.1fs truncated to %.0fs", len(audio_np) / SAMPLE_RATE,
+                        fe.nb_max_frames * fe.hop_length / SAMPLE_RATE)
+            mel = mel[:, :fe.nb_max_frames]
+        if mel.shape[1] < fe.nb_max_frames:
+            mel = np.pad(mel, [(0, 0), (0, fe.nb_max_frames - mel.shape[1])])
+        features.append(mel)
+
+    batch = ctranslate2.StorageView.from_array(np.ascontiguousarray(np.stack(features)))
+    encoder_output = model.model.encode(batch, to_cpu=False)
+
+    tokenizer = Tokenizer(model.hf_tokenizer, model.model.is_multilingual, task="transcribe", language=LANG)
+    prompt = model.get_prompt(tokenizer, [], without_timestamps=True)
+    results = model.model.generate(
+        encoder_output,
+        [prompt] * len(windows),
+        beam_size=1,
+        max_length=model.max_length,
+        return_no_speech_prob=True,
+        suppress_blank=True,
+        suppress_tokens=[-1],
+    )
+
+    texts = []
+    for result in results:
+        # No VAD inside the batched path, so gate silence on Whisper's own no-speech probability
+        if result.no_speech_prob > NO_SPEECH_THRESHOLD:
+            texts.append("")
+        else:
+            texts.append(tokenizer.decode(result.sequences_ids[0]).strip())
+    return texts
+
+def decode_words(audio_np: np.ndarray, prompt: str, model_name: str = None) -> list:
+    # Word-level decode for incremental streaming and word output; times are relative to the start of audio_np
+    model = registry.get(model_name)
+    segments, info = model.transcribe(
+        audio_np,
+        language=LANG,
+        task="transcribe",
+        beam_size=1,
+        vad_filter=True,
+        word_timestamps=True,
+        initial_prompt=prompt or None,
+        no_speech_threshold=NO_SPEECH_THRESHOLD,
+        condition_on_previous_text=False
+    )
+    return [(w.start, w.end, w.word, w.probability) for segment in segments for w in (segment.words or [])]
+
+batchers = {}  # model name -> MicroBatcher; only windows for the same model can share a batch
+
+def get_batcher(model_name: str) -> MicroBatcher:
+    if model_name not in batchers:
+        batch_fn = functools.partial(decode_batch, model_name=model_name)
+        # Run time and queue wait are recorded once per batch, not once per window in it
+        on_batch = lambda job, size: metrics.observe_decode(job, model_name, "batch")
+        batchers[model_name] = MicroBatcher(scheduler, batch_fn, max_batch=BATCH_MAX_SIZE, max_wait=BATCH_WAIT_MS / 1000,
+                                            on_batch=on_batch)
+    return batchers[model_name]
+
+def observe_lag(session_id: str, job):
+    # Audio that arrived while the decode waited and ran; job is None when it was refused
+    lag = session_lag.get(session_id)
+    if lag is None:
+        return
+    if job is None:
+        lag.rejected()
+    else:
+        lag.observe(job.queue_wait + job.run_time)
+        if session_id in session_emit:
+            session_emit[session_id].observe(job.queue_wait + job.run_time)
+
+async def cache_lookup(audio_np: np.ndarray, kind: str, **params):
+    # Returns (key, cached result or None); hashing and disk reads happen off the event loop
+    if not cache.enabled:
+        return None, None
+    def lookup():
+        key = cache.key(audio_np, kind=kind, lang=LANG, no_speech_threshold=NO_SPEECH_THRESHOLD, **params)
+        return key, cache.get(key, kind)
+    return await asyncio.to_thread(lookup)
+
+async def cache_store(key: str, value):
+    if key is None:
+        return
+    if cache.disk_dir:
+        await asyncio.to_thread(cache.put, key, value)
+    else:
+        cache.put(key, value)
+
+async def transcribe_window(audio_np: np.ndarray, session_id: str = "default", model_name: str = MODEL_NAME):
+    # Queue the decode on the inference scheduler so the event loop stays responsive
+    audio_sec = len(audio_np) / SAMPLE_RATE
+    # Batched windows skip Whisper's VAD, so they can decode differently from single ones
+    kind = "batch" if BATCH_MAX_SIZE > 1 else "window"
     try:
-        # Skip very small chunks that are likely incomplete
-        if len(raw_bytes) < 100:
-            return b''
-        
-        bio = io.BytesIO(raw_bytes)
-        with av.open(bio, 'r') as container:
-            if not container.streams.audio:
-                return b''
-            
-            stream = container.streams.audio[0]
-            resampler = av.audio.resampler.AudioResampler(format='s16', layout='mono', rate=16000)
-            pcm_chunks = []
-            
-            for frame in container.decode(stream):
-                resampled_frames = resampler.resample(frame)
-                for resampled_frame in resampled_frames:
-                    for plane in resampled_frame.planes:
-                        pcm_chunks.append(plane.to_bytes())
-            
-            return b''.join(pcm_chunks)
-    except Exception as e:
-        # Log the error but don't crash - return empty bytes
-        print(f"Audio decode error (chunk size: {len(raw_bytes)}): {e}")
-        return b''
-
-# Simple in-memory audio ring buffer per connection
-class RingBuffer:
-    def __init__(self, max_seconds: float, sr: int):
-        self.max_samples = int(max_seconds * sr)
-        self.buf = collections.deque(maxlen=self.max_samples)
-
-    def extend_pcm16(self, pcm: bytes):
-        # Expect 16-bit mono little-endian PCM at SAMPLE_RATE
-        import array
-        arr = array.array('h')
-        arr.frombytes(pcm)
-        self.buf.extend(arr)
-
-    def get_window(self, window_sec: float, overlap_sec: float):
-        n = len(self.buf)
-        if n == 0:
-            return None
-        win = int(window_sec * SAMPLE_RATE)
-        if n < win:
-            win = n
-        start = max(0, n - win)
-        import array
-        out = array.array('h', list(self.buf)[start:])
-        # Optionally drop the overlap on the text side client-side
-        return out.tobytes()
-
-async def transcribe_window(pcm16_bytes: bytes):
-    # Convert raw PCM16 bytes directly to numpy array for faster-whisper
+        key, cached = await cache_lookup(audio_np, kind, model=model_name)
+        if cached is not None:
+            return cached
+        await ensure_model(model_name)
+        if BATCH_MAX_SIZE > 1:
+            text, job, batch_size = await get_batcher(model_name).submit(session_id, audio_np)
+            observe_lag(session_id, job)
+            # Every window in a batch is padded to the same 30s input, so each costs an equal share
+            metrics.observe_rtf(model_name, job.run_time, audio_sec * batch_size)
+            if DEBUG:
+                log.debug("decode session=%s batch=%d audio=%.2fs queue_wait=%.0fms run=%.0fms",
+                          session_id, batch_size, audio_sec, job.queue_wait * 1000, job.run_time * 1000)
+        else:
+            job = await scheduler.submit(session_id, decode_audio, audio_np, model_name)
+            text = job.result
+            observe_lag(session_id, job)
+            metrics.observe_decode(job, model_name, "window", audio_sec)
+            if DEBUG:
+                log.debug("decode session=%s audio=%.2fs queue_wait=%.0fms run=%.0fms",
+                          session_id, audio_sec, job.queue_wait * 1000, job.run_time * 1000)
+        await cache_store(key, text)
+        return text
+    except SchedulerFull as e:
+        observe_lag(session_id, None)
+        metrics.DROPPED_DECODES.labels("queue_full").inc()
+        log.warning("decode skipped session=%s: %s", session_id, e)
+        return ""
+    except Exception:
+        metrics.DROPPED_DECODES.labels("error").inc()
+        log.exception("decode failed session=%s", session_id)
+        return ""
+
+def new_ring_buffer() -> AudioRingBuffer:
+    vad = None
+    if VAD_ENABLED:
+        vad = VoiceActivityDetector(SAMPLE_RATE, threshold_db=VAD_THRESHOLD_DB, silence_ms=VAD_SILENCE_MS)
+    return AudioRingBuffer(CHUNK_WINDOW_SEC + CHUNK_OVERLAP_SEC, SAMPLE_RATE, vad=vad)
+
+def has_speech_since(ring: AudioRingBuffer, index: int) -> bool:
+    return ring.vad is None or ring.vad.speech_since(index)
+
+def new_speech_sec(ring: AudioRingBuffer, index: int) -> float:
+    # Seconds of audio after index, counted only if some of it is speech
+    if ring.end_index <= index or not has_speech_since(ring, index):
+        return 0.0
+    return (ring.end_index - index) / SAMPLE_RATE
+
+def unfinished_speech(ring: AudioRingBuffer, transcriber, spec) -> bool:
+    # Incremental/speculative text that only a flush (endpoint, "flush" or idle timeout) would finalise
+    if transcriber:
+        return bool(transcriber.hypothesis) or new_speech_sec(ring, transcriber.last_decoded_end) > 0
+    if spec:
+        return new_speech_sec(ring, spec.utterance_start) > 0
+    return False
+
+def idle_flush_due(last_audio_at: float, ring: AudioRingBuffer, transcriber, spec) -> bool:
+    # The client stopped sending mid-utterance: no endpoint will come, so finalise what is open
+    return (last_audio_at is not None and time.perf_counter() - last_audio_at >= IDLE_FLUSH_SEC
+            and unfinished_speech(ring, transcriber, spec))
+
+def next_decode_wait(emit: EmitScheduler, ring: AudioRingBuffer, transcriber, spec, last_decoded_end: int,
+                     last_emit: float, degraded: bool, last_audio_at: float = None):
+    # How long the session loop may sleep without new messages; None when only new audio can make a decode due
+    idle = None
+    if (transcriber or spec) and last_audio_at is not None and unfinished_speech(ring, transcriber, spec):
+        idle = max(0.0, last_audio_at + IDLE_FLUSH_SEC - time.perf_counter())
+    if spec:
+        return idle  # otherwise speculative decodes are paced by the amount of new audio
+    if transcriber:
+        if not transcriber.ready():
+            return idle
+        last_decoded_end = transcriber.last_decoded_end
+    wait = emit.wait(last_emit, time.time(), new_speech_sec(ring, last_decoded_end), scheduler.load(), degraded)
+    return wait if idle is None else idle if wait is None else min(wait, idle)
+
+def new_emit_scheduler(target_sec: float) -> EmitScheduler:
+    return EmitScheduler(target_sec, min_interval=EMIT_MIN_INTERVAL_SEC, max_interval=EMIT_MAX_INTERVAL_SEC,
+                         target_load=EMIT_TARGET_LOAD, window_sec=CHUNK_WINDOW_SEC, min_window_sec=EMIT_MIN_WINDOW_SEC)
+
+def speech_window(ring: AudioRingBuffer, window_sec: float, utterance: tuple = None):
+    # Most recent window, clipped to the current utterance (or the given (start, end) one) when VAD is on;
+    # returns (audio, absolute start sample)
+    start = ring.end_index - int(window_sec * SAMPLE_RATE)
+    end = None
+    if utterance is not None:
+        start = max(start, utterance[0] - VAD_PADDING_SAMPLES)
+        end = utterance[1] + VAD_PADDING_SAMPLES
+    elif ring.vad is not None:
+        start = max(start, ring.vad.utterance_start - VAD_PADDING_SAMPLES)
+    return ring.get_range(start, end), max(start, ring.start_index)
+
+async def transcribe_window_words(audio_np: np.ndarray, session_id: str, model_name: str = MODEL_NAME):
+    # Like transcribe_window, but (start, end, word, probability) tuples relative to audio_np; None if the decode failed
     try:
-        import array
-        
-        duration_sec = len(pcm16_bytes) / (SAMPLE_RATE * 2)
-        print(f"[TRANSCRIBE] Processing {len(pcm16_bytes)} bytes of PCM data ({duration_sec:.2f}s) directly")
-        
-        # Convert PCM16 bytes to numpy array of float32 values
-        # PCM16 is signed 16-bit integers, we need to convert to float32 [-1.0, 1.0]
-        pcm_array = array.array('h')  # signed short (Int16)
-        pcm_array.frombytes(pcm16_bytes)
-        
-        # Convert to numpy array and normalize to [-1.0, 1.0]
-        audio_np = np.array(pcm_array, dtype=np.float32) / 32768.0
-        
-        print(f"[TRANSCRIBE] Converted to numpy array: shape={audio_np.shape}, dtype={audio_np.dtype}, range=[{audio_np.min():.3f}, {audio_np.max():.3f}]")
-        
-        # Now transcribe directly with the numpy array - much faster!
-        print(f"[TRANSCRIBE] Starting Whisper transcription directly from numpy array...")
-        segments, info = model.transcribe(
-            audio_np,  # Pass numpy array directly instead of file path
-            language=LANG,
-            task="transcribe",
-            beam_size=1,  # Fastest beam size
-            vad_filter=True,  # Enable VAD to filter silence
-            word_timestamps=False,
-            initial_prompt=None,
-            no_speech_threshold=0.6,  # Higher threshold to reduce false positives
-            condition_on_previous_text=False  # Don't condition on previous text for streaming
-        )
-        
-        print(f"[TRANSCRIBE] Whisper completed, detected language: {info.language}, probability: {info.language_probability:.2f}")
-        segment_texts = []
-        for i, segment in enumerate(segments):
-            # Filter out very short segments that might be noise
-            if len(segment.text.strip()) > 1:
-                print(f"[TRANSCRIBE] Segment {i}: '{segment.text}' (start: {segment.start:.2f}s, end: {segment.end:.2f}s)")
-                segment_texts.append(segment.text)
-        
-        text = " ".join(segment_texts)  # Use space to join segments
-        print(f"[TRANSCRIBE] Final combined text: '{text}' (length: {len(text)})")
-            
-        return text.strip()
-        
+        key, cached = await cache_lookup(audio_np, "words", model=model_name)
+        if cached is not None:
+            return [tuple(w) for w in cached]
+        await ensure_model(model_name)
+        job = await scheduler.submit(session_id, decode_words, audio_np, "", model_name)
+        observe_lag(session_id, job)
+        metrics.observe_decode(job, model_name, "words", len(audio_np) / SAMPLE_RATE)
+        await cache_store(key, job.result)
+        return job.result
+    except SchedulerFull as e:
+        observe_lag(session_id, None)
+        metrics.DROPPED_DECODES.labels("queue_full").inc()
+        log.warning("decode skipped session=%s: %s", session_id, e)
+    except Exception:
+        metrics.DROPPED_DECODES.labels("error").inc()
+        log.exception("decode failed session=%s", session_id)
+    return None
+
+async def send_words(ws: WebSocket, timeline: WordTimeline, audio_np: np.ndarray, start: int, session_id: str,
+                     model_name: str, log_words=None):
+    # Word output: decode the window with word timings and send only the words that changed since the last tick
+    words = await transcribe_window_words(audio_np, session_id, model_name)
+    if words is None:
+        return
+    offset = start / SAMPLE_RATE
+    final, update = timeline.update([(offset + w[0], offset + w[1]) + tuple(w[2:]) for w in words], offset)
+    if final and log_words:
+        log_words(final)
+    if update:
+        await ws.send_json(update)
+        metrics.observe_latency(ws.url.path, ws.state.last_audio_at)
+
+async def transcribe_incremental(transcriber: IncrementalTranscriber, session_id: str, model_name: str = MODEL_NAME):
+    # Decode only the uncommitted audio; returns (final_delta, partial_tail)
+    audio, start, prompt = transcriber.next_window()
+    if len(audio) == 0:
+        return "", ""
+    try:
+        await ensure_model(model_name)
+        job = await scheduler.submit(session_id, decode_words, audio, prompt, model_name)
+    except SchedulerFull as e:
+        observe_lag(session_id, None)
+        metrics.DROPPED_DECODES.labels("queue_full").inc()
+        log.warning("decode skipped session=%s: %s", session_id, e)
+        return "", ""
+    except Exception:
+        # Nothing was committed, so the same audio is decoded again on the next tick
+        metrics.DROPPED_DECODES.labels("error").inc()
+        log.exception("decode failed session=%s", session_id)
+        return "", ""
+    observe_lag(session_id, job)
+    metrics.observe_decode(job, model_name, "words", len(audio) / SAMPLE_RATE)
+    if DEBUG:
+        log.debug("decode session=%s incremental audio=%.2fs queue_wait=%.0fms run=%.0fms",
+                  session_id, len(audio) / SAMPLE_RATE, job.queue_wait * 1000, job.run_time * 1000)
+    return transcriber.update(job.result, start)
+
+async def flush_incremental(transcriber: IncrementalTranscriber, session_id: str, model_name: str = MODEL_NAME) -> str:
+    # Decode any remaining audio and commit the whole tail
+    final = ""
+    if transcriber.ring.end_index > transcriber.last_decoded_end:
+        final, _ = await transcribe_incremental(transcriber, session_id, model_name)
+    return " ".join(t for t in (final, transcriber.finish()) if t)
+
+async def speculative_step(ws: WebSocket, spec: SpeculativeTranscriber, endpoints: list, session_id: str,
+                           model_name: str, last_partial: str, log_result=None, flush: bool = False) -> str:
+    # Two-tier mode: the session's model finalises closed utterances, PARTIAL_MODEL keeps the open one fresh
+    closed = [spec.final_window(start - VAD_PADDING_SAMPLES, end + VAD_PADDING_SAMPLES) for start, end in endpoints]
+    if flush or spec.overdue():
+        closed.append(spec.final_window())
+    for audio in closed:
+        if len(audio) == 0:
+            continue
+        final = await transcribe_window(audio, session_id, model_name)
+        if final and log_result:
+            log_result(final, len(audio))
+        last_partial = await send_deltas(ws, final, "", last_partial)
+
+    if not has_speech_since(spec.ring, spec.last_partial_end):
+        spec.skip_silence(VAD_PADDING_SAMPLES)
+    elif spec.partial_ready():
+        partial = await transcribe_window(spec.partial_window(), session_id, PARTIAL_MODEL)
+        last_partial = await send_deltas(ws, "", partial, last_partial)
+    return last_partial
+
+async def send_deltas(ws: WebSocket, final: str, partial: str, last_partial: str) -> str:
+    # Incremental mode protocol: committed text goes out once as "final", the tail as "partial"
+    if final:
+        await ws.send_json({"type": "final", "text": final})
+    if final or partial != last_partial:
+        await ws.send_json({"type": "partial", "text": partial})
+        metrics.observe_latency(ws.url.path, ws.state.last_audio_at)
+    return partial
+
+async def admit(ws: WebSocket, endpoint: str) -> bool:
+    # Capacity check after accept, so the client sees a close code and reason rather than a bare 403
+    refused = await admission.acquire()
+    if refused:
+        metrics.REFUSED_SESSIONS.labels(endpoint).inc()
+        log.warning("session refused endpoint=%s: %s", endpoint, refused)
+        await ws.close(code=WS_CLOSE_TRY_AGAIN, reason=refused)
+        return False
+    metrics.ACTIVE_SESSIONS.labels(endpoint).inc()
+    return True
+
+async def release(endpoint: str, session_id: str):
+    metrics.ACTIVE_SESSIONS.labels(endpoint).dec()
+    session_lag.pop(session_id, None)
+    session_emit.pop(session_id, None)
+    await admission.release()
+
+async def receive_messages(ws: WebSocket, on_audio, inbox: asyncio.Queue):
+    # Reads the socket on its own task so audio keeps landing in the ring buffer while a decode is
+    # in flight; the next decode then covers the freshest audio instead of windows that queued up.
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            if msg.get("bytes") is not None:
+                # on_audio may turn a binary message into another kind (framed control messages)
+                inbox.put_nowait(on_audio(msg["bytes"]) or ("audio", None))
+            elif msg.get("text") is not None:
+                inbox.put_nowait(("text", msg["text"]))
     except Exception as e:
-        print(f"[TRANSCRIBE] ERROR: {e}")
-        import traceback
-        traceback.print_exc()
-        return ""
+        log.warning("receive failed: %s", e)
+    finally:
+        inbox.put_nowait(("close", None))
 
-# PCM Ring Buffer for raw audio frames
-class PCMRingBuffer:
-    def __init__(self, max_seconds: float, sr: int):
-        self.max_samples = int(max_seconds * sr)
-        self.buf = collections.deque(maxlen=self.max_samples)
-        self.sample_rate = sr
-        self.total_samples_received = 0
-        self.last_transcribed_position = 0
-
-    def extend_pcm16_frame(self, frame_bytes: bytes):
-        # Expect raw Int16 little-endian PCM at 16kHz
-        import array
-        arr = array.array('h')  # signed short (Int16)
-        arr.frombytes(frame_bytes)
-        self.buf.extend(arr)
-        self.total_samples_received += len(arr)
-
-    def get_window_bytes(self, window_sec: float):
-        n = len(self.buf)
-        if n == 0:
-            return None
-        win_samples = int(window_sec * self.sample_rate)
-        if n < win_samples:
-            win_samples = n
-        start = max(0, n - win_samples)
-        import array
-        out = array.array('h', list(self.buf)[start:])
-        return out.tobytes()
-    
-    def get_new_audio_bytes(self, window_sec: float):
-        """Get only new audio since last transcription"""
-        n = len(self.buf)
-        if n == 0:
-            return None
-        
-        # Calculate how many new samples we have
-        new_samples = self.total_samples_received - self.last_transcribed_position
-        if new_samples <= 0:
-            return None
-            
-        # Get a window that includes some overlap but focuses on new audio
-        win_samples = int(window_sec * self.sample_rate)
-        overlap_samples = int(2.0 * self.sample_rate)  # 2 second overlap for better context
-        
-        if n < win_samples:
-            # Not enough audio yet, return everything
-            start = 0
-            win_samples = n
-        else:
-            # Get window with overlap
-            start = max(0, n - win_samples)
-        
-        import array
-        out = array.array('h', list(self.buf)[start:])
-        
-        # Update position to mark what we've transcribed
-        self.last_transcribed_position = self.total_samples_received - overlap_samples
-        
-        return out.tobytes()
+async def next_messages(inbox: asyncio.Queue, timeout: float = None) -> list:
+    # Everything that arrived since the last decode, as one batch; empty if timeout passes first
+    try:
+        messages = [await asyncio.wait_for(inbox.get(), timeout)]
+    except asyncio.TimeoutError:
+        return []
+    while not inbox.empty():
+        messages.append(inbox.get_nowait())
+    return messages
+
+async def send_pressure(ws: WebSocket, lag: LagMonitor, model_name: str, interval: float):
+    # Tell clients to back off (send less often, or reconnect with a smaller model) while decodes lag
+    if not lag.pop_change():
+        return
+    if lag.degraded:
+        metrics.DEGRADED_SESSIONS.inc()
+        await ws.send_json({
+            "type": "degrade",
+            "lag_sec": round(lag.last_lag, 2),
+            "interval_sec": interval,
+            "model": PARTIAL_MODEL if PARTIAL_MODEL != model_name and PARTIAL_MODEL in registry.allowed_models else None,
+        })
+    else:
+        await ws.send_json({"type": "recover", "interval_sec": interval})
 
 @app.websocket("/ws")
-async def ws_transcribe(ws: WebSocket, db: Session = Depends(get_db)):
+async def ws_transcribe(ws: WebSocket):
     token = ws.query_params.get("token")
     if not token:
         await ws.close(code=4401)
         return
     verify(token)
+    try:
+        model_name = registry.resolve(ws.query_params.get("model"))
+        mode = streaming_mode(ws.query_params)
+    except (ModelNotAllowed, ValueError):
+        await ws.close(code=4400)
+        return
 
     await ws.accept()
+    if not await admit(ws, "/ws"):
+        return
+    ws.state.last_audio_at = None
     
-    # Create session in database
+    # Create session in database (written in the background)
     session_id = str(uuid.uuid4())
-    session = TranscriptionSession(session_id=session_id, user_token=token)
-    db.add(session)
-    db.commit()
-    print(f"Created transcription session: {session_id}")
+    writer.add_session(session_id, token)
+    log.info("session opened endpoint=/ws session=%s model=%s", session_id, model_name)
     
-    ring = RingBuffer(CHUNK_WINDOW_SEC + CHUNK_OVERLAP_SEC, SAMPLE_RATE)
+    ring = new_ring_buffer()
+    # One decoder for the whole connection: MediaRecorder chunks are slices of a single WebM stream
+    decoder = StreamingAudioDecoder(ring.extend_pcm16, asyncio.get_running_loop(), SAMPLE_RATE)
+    # Window mode sends plain text, so its clients only get control messages if they ask for them
+    control = mode != "window" or ws.query_params.get("control") == "1"
+    lag = session_lag[session_id] = LagMonitor(LAG_DEGRADE_SEC)
+    emit = session_emit[session_id] = new_emit_scheduler(EMIT_TARGET_SEC_WS)
+    # Window mode can send timed words as splices instead of the whole window's text
+    timeline = WordTimeline() if mode == "window" and ws.query_params.get("output") == "words" else None
+    transcriber = None
+    spec = None
+    if mode == "incremental":
+        transcriber = IncrementalTranscriber(ring, CHUNK_WINDOW_SEC, MIN_CHUNK_SEC)
+    elif mode == "speculative":
+        spec = SpeculativeTranscriber(ring, CHUNK_WINDOW_SEC, PARTIAL_INTERVAL_SEC)
+    last_partial = ""
+
+    def log_result(text: str, duration_samples: int = None, confidence: str = None):
+        # Queue transcription result for the database; never waits on the DB
+        writer.add_result(
+            session_id,
+            text,
+            audio_duration=int(duration_samples * 1000 / SAMPLE_RATE) if duration_samples is not None else None,  # milliseconds
+            confidence=confidence,
+        )
+
+    def log_words(words: list):
+        # Word output stores each word once, when it becomes final, with the mean word probability
+        text = "".join(w[2] for w in words).strip()
+        if text:
+            duration = int((words[-1][1] - words[0][0]) * SAMPLE_RATE)
+            log_result(text, duration, f"{sum(w[3] for w in words) / len(words):.3f}")
+
+    def on_audio(data: bytes):
+        # Decoded PCM lands in the ring buffer asynchronously
+        decoder.feed(data)
+        ws.state.last_audio_at = time.perf_counter()
+        metrics.FRAMES.labels("/ws").inc()
+
+    inbox = asyncio.Queue()
+    receiver = asyncio.create_task(receive_messages(ws, on_audio, inbox))
 
-    # A simple loop: receive PCM16 chunks, periodically transcribe the window and send partial text
+    # Audio arrives in the background; this loop decodes whenever the emit scheduler says a decode is
+    # due, waking on its own timer so audio left over when the client pauses still gets transcribed
     last_emit = 0.0
+    last_decoded_end = 0
+    wait = None
     try:
         while True:
-            msg = await ws.receive()
-            if "bytes" in msg:
-                pcm = opus_webm_to_pcm16_mono16k(msg["bytes"])
-                if pcm:  # Only add to buffer if we got valid PCM data
-                    ring.extend_pcm16(pcm)
-            elif "text" in msg:
-                # allow "flush" or "close" messages
-                if msg["text"] == "flush":
-                    pass
-                elif msg["text"] == "bye":
-                    break
+            messages = await next_messages(inbox, wait)
+            texts = [value for kind, value in messages if kind == "text"]
+            if any(kind == "close" for kind, _ in messages):
+                break
+            if decoder.failed:
+                # Not audio the decoder can read; nothing more from this connection will be either
+                log.warning("closing session=%s: audio decoder failed: %s", session_id, decoder.error)
+                await ws.close(code=WS_CLOSE_BAD_AUDIO, reason=f"cannot decode audio: {decoder.error}"[:120])
+                break
+            # allow "flush" or "close" messages
+            if ("flush" in texts or "bye" in texts) and transcriber:
+                final = await flush_incremental(transcriber, session_id, model_name)
+                if final:
+                    log_result(final)
+                last_partial = await send_deltas(ws, final, "", last_partial)
+            if ("flush" in texts or "bye" in texts) and spec:
+                last_partial = await speculative_step(ws, spec, [], session_id, model_name, last_partial, log_result, flush=True)
+            if "bye" in texts:
+                break
 
             now = time.time()
-            # Emit every ~1s if we have enough audio
-            if now - last_emit > 1.0:
-                window = ring.get_window(CHUNK_WINDOW_SEC, CHUNK_OVERLAP_SEC)
-                if window and len(window) > 0:
-                    text = await transcribe_window(window)
+            load = scheduler.load()
+            endpoints = ring.vad.pop_endpoints() if ring.vad is not None else []
+            idle = idle_flush_due(ws.state.last_audio_at, ring, transcriber, spec)
+            if spec:
+                # Speculative mode runs on every wakeup: partials are paced by PARTIAL_INTERVAL_SEC
+                last_partial = await speculative_step(ws, spec, endpoints, session_id, model_name, last_partial, log_result,
+                                                      flush=idle)
+            elif transcriber and (endpoints or idle):
+                # End of utterance: commit the whole tail right away
+                final = await flush_incremental(transcriber, session_id, model_name)
+                if final:
+                    log_result(final)
+                last_partial = await send_deltas(ws, final, "", last_partial)
+                last_emit = now
+            elif transcriber:
+                if not has_speech_since(ring, transcriber.last_decoded_end):
+                    transcriber.skip_silence(VAD_PADDING_SAMPLES)
+                elif transcriber.ready() and emit.due(last_emit, now, new_speech_sec(ring, transcriber.last_decoded_end),
+                                                      load, lag.degraded):
+                    final, partial = await transcribe_incremental(transcriber, session_id, model_name)
+                    if final:
+                        log_result(final)
+                    last_partial = await send_deltas(ws, final, partial, last_partial)
+                    last_emit = now
+            # Skip Whisper entirely while nobody is speaking
+            elif endpoints or emit.due(last_emit, now, new_speech_sec(ring, last_decoded_end), load, lag.degraded):
+                window, start = speech_window(ring, emit.window(load), endpoints[-1] if endpoints else None)
+                last_decoded_end = ring.end_index
+                if len(window) > 0 and timeline is not None:
+                    await send_words(ws, timeline, window, start, session_id, model_name, log_words)
+                elif len(window) > 0:
+                    text = await transcribe_window(window, session_id, model_name)
                     if text.strip():
-                        # Log transcription result to database
-                        result = TranscriptionResult(
-                            session_id=session_id,
-                            text=text,
-                            audio_duration=len(window) // (SAMPLE_RATE * 2) * 1000  # milliseconds
-                        )
-                        db.add(result)
-                        db.commit()
+                        log_result(text, len(window))
                         await ws.send_text(text)
+                        metrics.observe_latency("/ws", ws.state.last_audio_at)
                 last_emit = now
+            if control:
+                await send_pressure(ws, lag, model_name, emit.interval(load, lag.degraded))
+            wait = next_decode_wait(emit, ring, transcriber, spec, last_decoded_end, last_emit, lag.degraded,
+                                    ws.state.last_audio_at)
     except WebSocketDisconnect:
         pass
+    finally:
+        receiver.cancel()
+        if timeline is not None:
+            log_words(timeline.finish())
+        await release("/ws", session_id)
+        metrics.AUDIO_SECONDS.labels("/ws").inc(decoder.samples_out / SAMPLE_RATE)
+        if decoder.error is not None:
+            metrics.DROPPED_FRAMES.labels("/ws", "decoder_error").inc()
+        decoder.close()
+        await writer.flush()
+
+PCM_FORMATS = {"s16": ("<i2", PCM16_SCALE), "f32": ("<f4", 1.0)}  # ?format= -> (dtype, scale to [-1, 1])
+
+def pcm_format(params) -> tuple:
+    # Input format negotiated in the /ws-pcm16 URL: ?rate=48000&channels=2&format=f32
+    rate = int(params.get("rate", SAMPLE_RATE))
+    channels = int(params.get("channels", "1"))
+    sample_format = params.get("format", "s16")
+    if not MIN_RATE <= rate <= MAX_RATE or not 1 <= channels <= 8 or sample_format not in PCM_FORMATS:
+        raise ValueError(f"unsupported input format rate={rate} channels={channels} format={sample_format}")
+    return rate, channels, sample_format
+
+def new_pcm_session(session_id: str, model_name: str, mode: str, control: bool, words: bool,
+                    rate: int, channels: int, sample_format: str) -> types.SimpleNamespace:
+    # Everything a /ws-pcm16 session needs to carry on after a reconnect
+    ring = new_ring_buffer()
+    dtype, scale = PCM_FORMATS[sample_format]
+    return types.SimpleNamespace(
+        id=session_id,
+        model_name=model_name,
+        mode=mode,
+        control=control,
+        ring=ring,
+        transcriber=IncrementalTranscriber(ring, CHUNK_WINDOW_SEC, MIN_CHUNK_SEC) if mode == "incremental" else None,
+        spec=SpeculativeTranscriber(ring, CHUNK_WINDOW_SEC, PARTIAL_INTERVAL_SEC) if mode == "speculative" else None,
+        lag=LagMonitor(LAG_DEGRADE_SEC),
+        emit=new_emit_scheduler(EMIT_TARGET_SEC_PCM16),
+        timeline=WordTimeline() if words and mode == "window" else None,   # window mode word output
+        decoder=FrameDecoder(SAMPLE_RATE, channels),                    # framed audio
+        resampler=StreamingResampler(rate, SAMPLE_RATE, channels),       # unframed audio
+        input_dtype=dtype,
+        input_scale=scale,
+        raw_pcm16=sample_format == "s16" and rate == SAMPLE_RATE and channels == 1,  # no conversion needed
+        last_seq=-1,                    # highest audio frame sequence number buffered
+        pending=collections.deque(maxlen=SESSION_PENDING_MAX),  # results a dropped connection didn't get
+        last_partial="",
+        last_transcribed_position=0,    # absolute sample index
+        last_decoded_end=0,
+        last_emit=0.0,
+        transcription_count=0,
+    )
 
 @app.websocket("/ws-pcm16")
 async def ws_pcm16(websocket: WebSocket):
@@ -308,135 +818,348 @@ async def ws_pcm16(websocket: WebSocket):
     if not token:
         await websocket.close(code=4401)
         return
-    verify(token)
+    claims = verify(token)
+    try:
+        model_name = registry.resolve(websocket.query_params.get("model"))
+        input_format = pcm_format(websocket.query_params)
+        mode = streaming_mode(websocket.query_params)
+    except (ModelNotAllowed, ValueError):
+        await websocket.close(code=4400)
+        return
+    # Binary framing (see protocol.py); framed sessions can be resumed after a dropped connection
+    framed = websocket.query_params.get("protocol") == str(PROTOCOL_VERSION)
+    owner = claims.get("sub") or token
 
     await websocket.accept()
-    print("PCM16 WebSocket connection established")
-    
-    # Use PCM ring buffer for raw frames
-    pcm_ring = PCMRingBuffer(CHUNK_WINDOW_SEC + CHUNK_OVERLAP_SEC, SAMPLE_RATE)
-    
-    last_emit = 0.0
-    chunk_count = 0
-    transcription_count = 0
-    
+    if not await admit(websocket, "/ws-pcm16"):
+        return
+    websocket.state.last_audio_at = None
+    s = None
+    resume_id = websocket.query_params.get("resume")
+    if framed and resume_id:
+        s = sessions.resume(resume_id, owner)
+    resumed = s is not None
+    if s is None:
+        control = mode != "window" or websocket.query_params.get("control") == "1"
+        words = websocket.query_params.get("output") == "words"
+        s = new_pcm_session(str(uuid.uuid4()), model_name, mode, control, words, *input_format)
+    session_lag[s.id] = s.lag
+    session_emit[s.id] = s.emit
+    log.info("session %s endpoint=/ws-pcm16 session=%s model=%s framed=%s",
+             "resumed" if resumed else "opened", s.id, s.model_name, framed)
+
+    overlap_samples = int(2.0 * SAMPLE_RATE)  # 2 second overlap for better context
+    ws = SessionSocket(websocket, s.pending) if framed else websocket
+
+    def on_audio(frame_bytes: bytes):
+        # Check if this looks like a text message (small size, printable chars)
+        if len(frame_bytes) < 100:
+            try:
+                text_content = frame_bytes.decode('utf-8')
+                if DEBUG:
+                    log.debug("text as bytes session=%s %r", s.id, text_content)
+                return  # Skip processing as audio
+            except UnicodeDecodeError:
+                pass  # Not text, process as audio
+
+        metrics.FRAMES.labels("/ws-pcm16").inc()
+        # Add frame to ring buffer
+        try:
+            if s.raw_pcm16:
+                s.ring.extend_pcm16(frame_bytes)
+                samples = len(frame_bytes) // 2
+            else:
+                # Resample and downmix whatever the client negotiated to 16 kHz mono
+                audio = s.resampler.process(np.frombuffer(frame_bytes, dtype=s.input_dtype), s.input_scale)
+                s.ring.extend(audio)
+                samples = len(audio)
+            websocket.state.last_audio_at = time.perf_counter()
+            metrics.AUDIO_SECONDS.labels("/ws-pcm16").inc(samples / SAMPLE_RATE)
+        except Exception as buffer_error:
+            metrics.DROPPED_FRAMES.labels("/ws-pcm16", "bad_frame").inc()
+            log.warning("dropped frame session=%s bytes=%d: %s", s.id, len(frame_bytes), buffer_error)
+
+    def on_frame(data: bytes):
+        try:
+            frame = parse_frame(data)
+            if frame.type == CONTROL:
+                return ("text", bytes(frame.payload).decode("utf-8"))
+            metrics.FRAMES.labels("/ws-pcm16").inc()
+            if frame.seq <= s.last_seq:
+                # Resent after a reconnect, but already buffered
+                metrics.DROPPED_FRAMES.labels("/ws-pcm16", "duplicate").inc()
+                return None
+            samples = s.decoder.decode(frame)
+        except (ProtocolError, UnicodeDecodeError) as e:
+            metrics.DROPPED_FRAMES.labels("/ws-pcm16", "bad_frame").inc()
+            log.warning("dropped frame session=%s bytes=%d: %s", s.id, len(data), e)
+            return None
+        s.last_seq = frame.seq
+        s.ring.extend(samples)
+        websocket.state.last_audio_at = time.perf_counter()
+        metrics.AUDIO_SECONDS.labels("/ws-pcm16").inc(len(samples) / SAMPLE_RATE)
+
+    inbox = asyncio.Queue()
+    receiver = asyncio.create_task(receive_messages(websocket, on_frame if framed else on_audio, inbox))
+    finished = False
+    acked = -1
+    wait = None
+
     try:
+        if framed:
+            await websocket.send_json({"type": "session", "session_id": s.id, "resumed": resumed, "last_seq": s.last_seq})
+            await ws.replay()
         while True:
-            # Receive data (could be bytes or text)
-            try:
-                message = await websocket.receive()
-                print(f"[RAW MESSAGE] Received: {message}")
-                
-                if "bytes" in message:
-                    frame_bytes = message["bytes"]
-                    
-                    # Check if this looks like a text message (small size, printable chars)
-                    if len(frame_bytes) < 100:
-                        try:
-                            text_content = frame_bytes.decode('utf-8')
-                            print(f"[TEXT AS BYTES] Received: '{text_content}' ({len(frame_bytes)} bytes)")
-                            continue  # Skip processing as audio
-                        except UnicodeDecodeError:
-                            pass  # Not text, process as audio
-                    
-                    chunk_count += 1
-                    print(f"[CHUNK #{chunk_count}] Received {len(frame_bytes)} bytes of PCM data")
-                    
-                    # Add frame to ring buffer
-                    try:
-                        pcm_ring.extend_pcm16_frame(frame_bytes)
-                        print(f"[BUFFER] Total samples in buffer: {len(pcm_ring.buf)}, total received: {pcm_ring.total_samples_received}")
-                    except Exception as buffer_error:
-                        print(f"[BUFFER ERROR] Failed to add frame to buffer: {buffer_error}")
-                        continue
-                        
-                elif "text" in message:
-                    print(f"[TEXT MESSAGE] Received: {message['text']}")
-                    continue
-                else:
-                    print(f"[UNKNOWN MESSAGE] Type: {type(message)}, Content: {message}")
-                    continue
-            except Exception as msg_error:
-                print(f"[MESSAGE ERROR] {msg_error}")
+            messages = await next_messages(inbox, wait)
+            if any(kind == "close" for kind, _ in messages):
                 break
+            if framed and s.last_seq > acked:
+                # Everything up to last_seq is buffered; a resumed session continues after it
+                await ws.send_bytes(build_frame(ACK, s.last_seq))
+                acked = s.last_seq
+            texts = [text for kind, text in messages if kind == "text"]
+            for text in texts:
+                if DEBUG:
+                    log.debug("text message session=%s %r", s.id, text)
+            if ("flush" in texts or "bye" in texts) and s.transcriber:
+                final = await flush_incremental(s.transcriber, s.id, s.model_name)
+                s.last_partial = await send_deltas(ws, final, "", s.last_partial)
+            elif ("flush" in texts or "bye" in texts) and s.spec:
+                s.last_partial = await speculative_step(ws, s.spec, [], s.id, s.model_name, s.last_partial, flush=True)
+            if "bye" in texts:
+                finished = True
+                break
+            if messages and all(kind == "text" for kind, _ in messages):
+                continue
             
             now = time.time()
-            # Emit transcription every ~2s for longer, more accurate chunks
-            if now - last_emit > 2.0:
+            load = scheduler.load()
+            endpoints = s.ring.vad.pop_endpoints() if s.ring.vad is not None else []
+            idle = idle_flush_due(websocket.state.last_audio_at, s.ring, s.transcriber, s.spec)
+            if s.spec:
+                s.last_partial = await speculative_step(ws, s.spec, endpoints, s.id, s.model_name, s.last_partial, flush=idle)
+            elif s.transcriber:
+                if endpoints or idle:
+                    # End of utterance: commit the whole tail right away
+                    final = await flush_incremental(s.transcriber, s.id, s.model_name)
+                    s.last_partial = await send_deltas(ws, final, "", s.last_partial)
+                    s.last_emit = now
+                elif not has_speech_since(s.ring, s.transcriber.last_decoded_end):
+                    s.transcriber.skip_silence(VAD_PADDING_SAMPLES)
+                # Incremental mode: decode only uncommitted audio once enough has arrived
+                elif s.transcriber.ready() and s.emit.due(s.last_emit, now, new_speech_sec(s.ring, s.transcriber.last_decoded_end),
+                                                          load, s.lag.degraded):
+                    final, partial = await transcribe_incremental(s.transcriber, s.id, s.model_name)
+                    s.last_partial = await send_deltas(ws, final, partial, s.last_partial)
+                    s.last_emit = now
+
+            # Emit transcription when the emit scheduler says it's due, or right away at end of utterance
+            elif endpoints or s.emit.due(s.last_emit, now, new_speech_sec(s.ring, s.last_decoded_end), load, s.lag.degraded):
                 try:
-                    # Use new audio method for progressive transcription
-                    window_bytes = pcm_ring.get_new_audio_bytes(CHUNK_WINDOW_SEC)
-                    print(f"[TRANSCRIBE] Attempting transcription with {len(window_bytes) if window_bytes else 0} bytes of new audio")
-                    
-                    # Require at least 2 seconds of audio (64000 bytes = 32000 samples * 2 bytes) for better accuracy
-                    if window_bytes and len(window_bytes) >= 64000:
-                        transcription_count += 1
-                        print(f"[TRANSCRIBE #{transcription_count}] Starting transcription of {len(window_bytes)} bytes...")
-                        
-                        text = await transcribe_window(window_bytes)
-                        
-                        print(f"[TRANSCRIBE #{transcription_count}] Result: '{text}' (length: {len(text)})")
-                        
-                        if text.strip():  # Only send non-empty text
-                            await websocket.send_text(text)
-                            print(f"[SENT #{transcription_count}] Sent to client: '{text}'")
-                        else:
-                            print(f"[SKIP #{transcription_count}] Empty transcription, not sending")
+                    min_samples = 2 * SAMPLE_RATE
+                    if endpoints:
+                        # Final decode of the utterance that just ended, however short
+                        window, start = speech_window(s.ring, CHUNK_WINDOW_SEC, endpoints[-1])
+                        s.last_transcribed_position = s.ring.end_index
+                        min_samples = int(0.3 * SAMPLE_RATE)
+                    # Only transcribe if speech arrived since the last window (minus the overlap)
+                    elif s.ring.end_index > s.last_transcribed_position and has_speech_since(s.ring, s.last_decoded_end):
+                        window, start = speech_window(s.ring, s.emit.window(load))
+                        s.last_transcribed_position = s.ring.end_index - overlap_samples
                     else:
-                        audio_bytes = len(window_bytes) if window_bytes else 0
-                        duration_sec = audio_bytes / (SAMPLE_RATE * 2) if audio_bytes > 0 else 0
-                        print(f"[SKIP] Not enough new audio data for transcription ({audio_bytes} bytes = {duration_sec:.2f}s)")
-                except Exception as transcribe_error:
-                    print(f"[TRANSCRIBE ERROR] {transcribe_error}")
-                    import traceback
-                    traceback.print_exc()
-                        
-                last_emit = now
-                
+                        window, start = s.ring.get_window(0), s.ring.end_index
+                    s.last_decoded_end = s.ring.end_index
+
+                    # Require at least 2 seconds of audio for better accuracy
+                    if len(window) >= min_samples and s.timeline is not None:
+                        await send_words(ws, s.timeline, window, start, s.id, s.model_name)
+                    elif len(window) >= min_samples:
+                        s.transcription_count += 1
+                        text = await transcribe_window(window, s.id, s.model_name)
+                        if text.strip():  # Only send non-empty text
+                            await ws.send_text(text)
+                            metrics.observe_latency("/ws-pcm16", websocket.state.last_audio_at)
+                            if DEBUG:
+                                log.debug("sent session=%s #%d %r", s.id, s.transcription_count, text)
+                except WebSocketDisconnect:
+                    raise
+                except Exception:
+                    log.exception("transcription failed session=%s", s.id)
+
+                s.last_emit = now
+            if s.control:
+                await send_pressure(ws, s.lag, s.model_name, s.emit.interval(load, s.lag.degraded))
+            wait = next_decode_wait(s.emit, s.ring, s.transcriber, s.spec, s.last_decoded_end, s.last_emit, s.lag.degraded,
+                                    websocket.state.last_audio_at)
     except WebSocketDisconnect:
-        print("PCM16 WebSocket disconnected")
-    except Exception as e:
-        print(f"PCM16 WebSocket error: {e}")
-        import traceback
-        traceback.print_exc()
+        pass
+    except Exception:
+        log.exception("PCM16 WebSocket error session=%s", s.id)
         await websocket.close()
+    finally:
+        receiver.cancel()
+        await release("/ws-pcm16", s.id)
+        if framed and not finished and sessions.detach(s.id, owner, s):
+            log.info("session detached endpoint=/ws-pcm16 session=%s last_seq=%d", s.id, s.last_seq)
 
-# Non-streaming HTTP endpoint for Gradio sanity test
-from fastapi import UploadFile, File
-import tempfile
-@app.post("/transcribe")
-async def transcribe_file(file: UploadFile = File(...)):
-    # Save uploaded file to a temporary file that faster-whisper can read
-    tmp_path = None
+# HTTP file upload: decoded in memory, split on silence, chunks transcribed in parallel
+from fastapi import UploadFile, File, Query
+from fastapi.responses import StreamingResponse
+
+def decode_chunk(audio_np: np.ndarray, offset_sec: float, model_name: str = None) -> list:
+    # Segments with timestamps relative to the start of the whole file
+    model = registry.get(model_name)
+    segments, info = model.transcribe(
+        audio_np,
+        language=LANG,
+        task="transcribe",
+        beam_size=1,
+        vad_filter=False,
+        word_timestamps=False,
+        initial_prompt=None
+    )
+    return [
+        {"start": round(offset_sec + s.start, 2), "end": round(offset_sec + s.end, 2), "text": s.text.strip()}
+        for s in segments
+    ]
+
+def shift_segments(segments: list, offset_sec: float, digits: int = 2) -> list:
+    return [{**s, "start": round(s["start"] + offset_sec, digits), "end": round(s["end"] + offset_sec, digits)}
+            for s in segments]
+
+# Stands in for the scheduler job of a chunk answered from the cache
+CachedChunk = collections.namedtuple("CachedChunk", "result queue_wait run_time")
+
+async def transcribe_chunks(audio_np: np.ndarray, upload_id: str, model_name: str = MODEL_NAME):
+    # Keep a few chunks in flight so they spread across the worker pool, and yield
+    # (index, job) in file order as soon as each chunk and all before it are done
+    async def run(start: int, end: int):
+        offset = start / SAMPLE_RATE
+        # Cached per chunk, relative to the chunk start: the same audio can sit anywhere in a file
+        key, cached = await cache_lookup(audio_np[start:end], "file", model=model_name)
+        if cached is not None:
+            return CachedChunk(shift_segments(cached, offset), 0.0, 0.0)
+        await ensure_model(model_name)
+        while True:
+            try:
+                job = await scheduler.submit(upload_id, decode_chunk, audio_np[start:end], offset, model_name, kind="file")
+                metrics.observe_decode(job, model_name, "file", (end - start) / SAMPLE_RATE)
+                await cache_store(key, shift_segments(job.result, -offset, 6))
+                return job
+            except SchedulerFull:
+                await asyncio.sleep(0.2)  # back off until live sessions free up the queue
+
+    chunks = iter(split_on_silence(audio_np, SAMPLE_RATE, FILE_CHUNK_SEC))
+    pending = collections.deque()
+    for start, end in chunks:
+        pending.append(asyncio.create_task(run(start, end)))
+        if len(pending) >= INFERENCE_WORKERS + 1:
+            break
+    index = 0
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file.flush()
-            tmp_path = tmp_file.name
-        
-        # File is now closed, safe to use with faster-whisper
-        segments, info = model.transcribe(
-            tmp_path,
-            language=LANG,
-            task="transcribe",
-            beam_size=1,
-            vad_filter=False,
-            word_timestamps=False,
-            initial_prompt=None
-        )
-        text = "".join(s.text for s in segments)
-        
-        return {"text": text.strip()}
-    
+        while pending:
+            job = await pending.popleft()
+            nxt = next(chunks, None)
+            if nxt is not None:
+                pending.append(asyncio.create_task(run(*nxt)))
+            yield index, job
+            index += 1
     finally:
-        # Clean up the temporary file safely
-        if tmp_path and os.path.exists(tmp_path):
-            try:
-                os.unlink(tmp_path)
-            except (OSError, PermissionError):
-                # If we can't delete it immediately, it will be cleaned up later
-                pass
+        # Client went away mid-stream: don't decode the rest
+        for task in pending:
+            task.cancel()
+
+@app.post("/transcribe")
+async def transcribe_file(file: UploadFile = File(...), stream: bool = False, model_name: str = Query(None, alias="model")):
+    try:
+        model_name = registry.resolve(model_name)
+    except ModelNotAllowed as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        # No temp file: decode straight from the upload's spooled file object, off the event loop
+        audio_np = await asyncio.to_thread(decode_audio_file, file.file, SAMPLE_RATE)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode audio: {e}")
+    upload_id = f"upload-{uuid.uuid4()}"
+    duration = round(len(audio_np) / SAMPLE_RATE, 2)
+
+    if stream:
+        # NDJSON: one line per chunk as soon as it is transcribed, then a summary line
+        async def ndjson():
+            async for index, job in transcribe_chunks(audio_np, upload_id, model_name):
+                yield json.dumps({
+                    "chunk": index,
+                    "segments": job.result,
+                    "cached": isinstance(job, CachedChunk),
+                    "queue_wait_ms": round(job.queue_wait * 1000, 1),
+                    "run_time_ms": round(job.run_time * 1000, 1),
+                }) + "\n"
+            yield json.dumps({"done": True, "duration": duration}) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    segments = []
+    queue_wait = run_time = 0.0
+    cached = 0
+    async for index, job in transcribe_chunks(audio_np, upload_id, model_name):
+        segments.extend(job.result)
+        cached += isinstance(job, CachedChunk)
+        queue_wait += job.queue_wait
+        run_time += job.run_time
+    return {
+        "text": " ".join(s["text"] for s in segments if s["text"]),
+        "segments": segments,
+        "duration": duration,
+        "queue_wait_ms": round(queue_wait * 1000, 1),
+        "run_time_ms": round(run_time * 1000, 1),
+        "cached_chunks": cached,
+    }
+
+# Transcript history: paginated reads and bulk export of what streaming sessions wrote
+from fastapi import Header
+import history
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+def history_token(token: str, authorization: str) -> str:
+    # Sessions are stored under the token they were opened with; take it from ?token= or a Bearer header
+    if authorization and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing token")
+    verify(token)
+    return token
+
+@app.get("/sessions")
+async def list_sessions(token: str = None, authorization: str = Header(None), limit: int = Query(50, ge=1, le=500),
+                        cursor: str = None):
+    user_token = history_token(token, authorization)
+    try:
+        return await asyncio.to_thread(history.list_sessions, user_token, limit, cursor)
+    except history.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/sessions/{session_id}/transcript")
+async def session_transcript(session_id: str, token: str = None, authorization: str = Header(None),
+                             limit: int = Query(200, ge=1, le=1000), cursor: str = None):
+    user_token = history_token(token, authorization)
+    if not await asyncio.to_thread(history.owns_session, session_id, user_token):
+        raise HTTPException(status_code=404, detail="Session not found")
+    try:
+        return await asyncio.to_thread(history.get_transcript, session_id, limit, cursor)
+    except history.InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/export")
+async def export_transcripts(token: str = None, authorization: str = Header(None), session_id: str = None,
+                             export_format: str = Query("ndjson", alias="format")):
+    user_token = history_token(token, authorization)
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    # A plain generator: Starlette iterates it on a worker thread, so the database cursor never blocks the loop
+    rows = history.export_results(user_token, session_id, export_format)
+    filename = f"transcripts.{export_format}"
+    return StreamingResponse(rows, media_type=EXPORT_FORMATS[export_format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 if __name__ == "__main__":
     # For local development - Railway uses hypercorn via Procfile
@@ -0,0 +1,107 @@
+"""
+Streaming sessions that survive a dropped connection.
+
+When a resumable connection drops, its session state (ring buffer,
+transcriber, decode positions, last sequence number) is parked here for a
+grace period. A client that reconnects with ``?resume=<session id>`` picks it
+up again: audio already received is not resent and nothing already decoded is
+decoded again. Sessions not resumed in time are dropped, together with any
+open text and undelivered results; /ws-pcm16 does not persist transcripts, so
+there is nowhere to finalise them to.
+"""
+import asyncio
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SessionSocket:
+    """WebSocket wrapper that keeps messages which could not be sent.
+
+    Results of a decode that finishes after the connection dropped are
+    delivered to the next connection of the session instead of being lost.
+    """
+
+    def __init__(self, ws, pending: collections.deque):
+        self._ws = ws
+        self.pending = pending
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+    async def send_text(self, data: str):
+        await self._send("send_text", data)
+
+    async def send_json(self, data):
+        await self._send("send_json", data)
+
+    async def send_bytes(self, data: bytes):
+        # Acks are only meaningful on the connection they were sent on, so they are never kept
+        await self._ws.send_bytes(data)
+
+    async def replay(self):
+        """Send what earlier connections could not, oldest first."""
+        while self.pending:
+            method, data = self.pending[0]
+            await getattr(self._ws, method)(data)
+            self.pending.popleft()
+
+    async def _send(self, method: str, data):
+        try:
+            await getattr(self._ws, method)(data)
+        except Exception:
+            self.pending.append((method, data))
+            raise
+
+
+class SessionStore:
+    """Detached sessions awaiting a reconnect, each expiring after grace_sec."""
+
+    def __init__(self, grace_sec: float = 30.0, max_sessions: int = 1000):
+        self.grace_sec = grace_sec
+        self.max_sessions = max_sessions
+        self._sessions = {}  # session id -> (owner, state, expiry handle, on_expire)
+        # Stats
+        self.resumed = 0
+        self.expired = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.grace_sec > 0
+
+    def detach(self, session_id: str, owner: str, state, on_expire=None) -> bool:
+        """Park a session; on_expire(state) runs if it isn't resumed in time. False if it can't be kept."""
+        if not self.enabled or len(self._sessions) >= self.max_sessions:
+            return False
+        handle = asyncio.get_running_loop().call_later(self.grace_sec, self._expire, session_id)
+        self._sessions[session_id] = (owner, state, handle, on_expire)
+        return True
+
+    def resume(self, session_id: str, owner: str):
+        """The parked state of session_id if owner matches, else None."""
+        entry = self._sessions.get(session_id)
+        if entry is None or entry[0] != owner:
+            return None
+        del self._sessions[session_id]
+        entry[2].cancel()
+        self.resumed += 1
+        return entry[1]
+
+    def _expire(self, session_id: str):
+        _, state, _, on_expire = self._sessions.pop(session_id)
+        self.expired += 1
+        log.info("session expired without resuming session=%s", session_id)
+        if on_expire is not None:
+            try:
+                on_expire(state)
+            except Exception:
+                log.exception("session cleanup failed session=%s", session_id)
+
+    def stats(self) -> dict:
+        return {
+            "detached": len(self._sessions),
+            "grace_sec": self.grace_sec,
+            "resumed": self.resumed,
+            "expired": self.expired,
+        }
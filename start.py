@@ -2,22 +2,38 @@
 """
 Railway startup script for Whisper WebSocket Server
 """
+import multiprocessing
 import os
 import uvicorn
-from server import app
+
+def start_inference_process():
+    # One process holds the models for every web worker (INFERENCE_EXECUTOR=remote)
+    import inference_server
+    process = multiprocessing.get_context("spawn").Process(target=inference_server.serve, name="inference", daemon=True)
+    process.start()
+    print(f"Inference process started (pid {process.pid})")
+    return process
 
 def main():
     port = int(os.environ.get("PORT", 8000))
     host = os.environ.get("HOST", "0.0.0.0")
-    
+    workers = int(os.environ.get("WEB_WORKERS", 1))
+    remote = os.environ.get("INFERENCE_EXECUTOR") == "remote"
+
     print(f"Starting Whisper WebSocket Server on {host}:{port}")
     print(f"Model: {os.environ.get('MODEL_NAME', 'small.en')}")
     print(f"Language: {os.environ.get('WHISPER_LANG', 'en')}")
-    
+    print(f"Web workers: {workers}")
+    if workers > 1 and not remote:
+        print("Warning: each web worker loads its own model copy; set INFERENCE_EXECUTOR=remote to share one")
+    if remote and os.environ.get("INFERENCE_SPAWN", "1") == "1":
+        start_inference_process()
+
     uvicorn.run(
-        app,
+        "server:app",
         host=host,
         port=port,
+        workers=workers,
         log_level="info",
         access_log=True
     )
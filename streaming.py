@@ -0,0 +1,323 @@
+"""
+Incremental streaming transcription.
+
+Instead of re-decoding a fixed window every tick, only the audio after the
+last committed word is decoded. A word is committed once two consecutive
+hypotheses agree on it (LocalAgreement-2); whatever is still unconfirmed is
+reported as the partial tail.
+"""
+from audio import AudioRingBuffer
+
+PROMPT_CHARS = 200  # committed text fed back as initial_prompt for context
+
+
+def _norm(word: str) -> str:
+    return word.strip().lower().strip(".,!?;:\"'")
+
+
+def words_text(words: list) -> str:
+    return "".join(w[2] for w in words).strip()
+
+
+class IncrementalTranscriber:
+    """Tracks committed words and the unconfirmed tail for one session.
+
+    Words are (start, end, text, probability) tuples with absolute session
+    times in seconds. Typical use per tick::
+
+        if transcriber.ready():
+            audio, start, prompt = transcriber.next_window()
+            words = <decode audio with word timestamps, times relative to audio>
+            final, partial = transcriber.update(words, start)
+    """
+
+    def __init__(self, ring: AudioRingBuffer, max_window_sec: float = 10.0, min_chunk_sec: float = 1.0):
+        self.ring = ring
+        self.sample_rate = ring.sample_rate
+        self.max_window = int(max_window_sec * self.sample_rate)
+        self.min_chunk = int(min_chunk_sec * self.sample_rate)
+        self.committed = []
+        self.hypothesis = []
+        self.buffer_start = ring.start_index  # absolute sample where uncommitted audio begins
+        self.last_decoded_end = self.buffer_start
+
+    def ready(self) -> bool:
+        """True once enough new audio has arrived since the last decode."""
+        return self.ring.end_index - self.last_decoded_end >= self.min_chunk
+
+    def prompt(self) -> str:
+        return words_text(self.committed)[-PROMPT_CHARS:]
+
+    def next_window(self):
+        """Return (audio, window_start, prompt) for the uncommitted region."""
+        start = max(self.buffer_start, self.ring.start_index)
+        audio = self.ring.get_range(start)
+        self.last_decoded_end = self.ring.end_index
+        return audio, start, self.prompt()
+
+    def update(self, words: list, window_start: int):
+        """Merge a new hypothesis; returns (newly_committed_text, partial_text)."""
+        offset = window_start / self.sample_rate
+        words = [(offset + w[0], offset + w[1]) + tuple(w[2:]) for w in words]
+        words = self._drop_committed(words)
+
+        # LocalAgreement-2: commit the prefix both hypotheses agree on
+        commit = []
+        for new, old in zip(words, self.hypothesis):
+            if _norm(new[2]) != _norm(old[2]):
+                break
+            commit.append(new)
+        self.hypothesis = words[len(commit):]
+
+        if commit:
+            self.buffer_start = max(self.buffer_start, int(commit[-1][1] * self.sample_rate))
+        elif not words:
+            # Nothing recognised: no need to keep decoding this silence, keep a short margin
+            self.buffer_start = max(self.buffer_start, self.last_decoded_end - self.min_chunk)
+
+        if self.ring.end_index - self.buffer_start > self.max_window:
+            # Hypothesis never stabilised within the window; force it out
+            commit += self.hypothesis
+            self.buffer_start = self._force_start()
+            self.hypothesis = []
+
+        self.committed += commit
+        self.ring.discard_before(self.buffer_start)
+        return words_text(commit), words_text(self.hypothesis)
+
+    def skip_silence(self, keep: int = 0):
+        """Advance past audio without speech so it is never decoded, keeping `keep` samples."""
+        if self.hypothesis:
+            return
+        self.buffer_start = max(self.buffer_start, self.ring.end_index - keep)
+        self.last_decoded_end = max(self.last_decoded_end, self.ring.end_index)
+        self.ring.discard_before(self.buffer_start)
+
+    def finish(self) -> str:
+        """Commit whatever is left in the tail (end of stream / flush)."""
+        tail = self.hypothesis
+        self.committed += tail
+        self.hypothesis = []
+        self.buffer_start = self.ring.end_index
+        self.last_decoded_end = self.buffer_start
+        self.ring.discard_before(self.buffer_start)
+        return words_text(tail)
+
+    def _force_start(self) -> int:
+        if self.hypothesis:
+            return max(self.buffer_start, int(self.hypothesis[-1][1] * self.sample_rate))
+        return self.ring.end_index - self.max_window // 2
+
+    def _drop_committed(self, words: list) -> list:
+        if not self.committed:
+            return words
+        committed_end = self.committed[-1][1]
+        words = [w for w in words if w[0] > committed_end - 0.1]
+        # The first words after a trim often repeat the last committed ones
+        for n in range(min(5, len(words), len(self.committed)), 0, -1):
+            if abs(words[0][0] - committed_end) > 1.0:
+                break
+            tail = [_norm(w[2]) for w in self.committed[-n:]]
+            if [_norm(w[2]) for w in words[:n]] == tail:
+                return words[n:]
+        return words
+
+
+class SpeculativeTranscriber:
+    """Two-tier streaming state for one session.
+
+    A fast model re-decodes the open utterance for partials as audio
+    arrives; once the utterance closes (VAD endpoint, or it grows past
+    max_window_sec) its audio is handed out once for the accurate model, whose
+    text is final and replaces the partial.
+    """
+
+    def __init__(self, ring: AudioRingBuffer, max_window_sec: float = 10.0, partial_interval_sec: float = 0.5):
+        self.ring = ring
+        self.max_window = int(max_window_sec * ring.sample_rate)
+        self.partial_interval = int(partial_interval_sec * ring.sample_rate)
+        self.utterance_start = ring.end_index   # absolute sample where the open utterance begins
+        self.last_partial_end = self.utterance_start
+
+    def partial_ready(self) -> bool:
+        return self.ring.end_index - self.last_partial_end >= self.partial_interval
+
+    def overdue(self) -> bool:
+        """True if the open utterance has outgrown the window and must be finalised now."""
+        return self.ring.end_index - self.utterance_start > self.max_window
+
+    def partial_window(self):
+        self.last_partial_end = self.ring.end_index
+        return self.ring.get_range(self.utterance_start)
+
+    def final_window(self, start: int = None, end: int = None):
+        """Close the open utterance at `end` (default: now) and return its audio."""
+        end = self.ring.end_index if end is None else min(end, self.ring.end_index)
+        start = self.utterance_start if start is None else max(start, self.utterance_start)
+        audio = self.ring.get_range(start, end)
+        self.utterance_start = end
+        self.last_partial_end = end
+        return audio
+
+    def skip_silence(self, keep: int = 0):
+        """Move the utterance start past audio without speech."""
+        self.utterance_start = max(self.utterance_start, self.ring.end_index - keep)
+        self.last_partial_end = max(self.last_partial_end, self.ring.end_index)
+
+
+class LagMonitor:
+    """Decides when a session's decodes have fallen too far behind its audio.
+
+    Each finished decode reports its latency (queue wait plus run time), which
+    is how much newer audio arrived while it was in flight. After ``patience``
+    decodes in a row over ``threshold_sec`` the session is degraded; it
+    recovers once a decode comes back under half the threshold.
+    """
+
+    def __init__(self, threshold_sec: float = 3.0, patience: int = 2):
+        self.threshold = threshold_sec
+        self.patience = max(1, patience)
+        self.degraded = False
+        self.last_lag = 0.0
+        self._over = 0
+        self._changed = False
+
+    def observe(self, lag_sec: float):
+        self.last_lag = lag_sec
+        if not self.threshold:
+            return
+        self._over = self._over + 1 if lag_sec > self.threshold else 0
+        self._update(lag_sec)
+
+    def rejected(self):
+        """A decode was refused outright (queue full); counts as over the threshold."""
+        if self.threshold:
+            self._over += 1
+            self._update(None)
+
+    def _update(self, lag_sec: float):
+        if not self.degraded and self._over >= self.patience:
+            self.degraded = self._changed = True
+        elif self.degraded and lag_sec is not None and lag_sec < self.threshold / 2:
+            self.degraded = False
+            self._changed = True
+
+    def pop_change(self) -> bool:
+        """True once after each switch between degraded and normal."""
+        changed, self._changed = self._changed, False
+        return changed
+
+
+class EmitScheduler:
+    """Picks when a streaming session decodes next, and how much audio it decodes.
+
+    Audio that arrives just after a decode reaches the client one interval
+    plus one decode later, so the interval is what the latency target leaves
+    after the measured decode time (but never less than one decode, which
+    would only queue work). The interval then scales with inference load
+    relative to ``target_load``: below it sessions decode more often, down to
+    ``min_interval``, and above it they back off proportionally so together
+    they ask for no more than the workers can do. Window mode windows shrink
+    under load too, since decode time grows with the text in the window.
+    """
+
+    def __init__(self, target_sec: float = 1.5, min_interval: float = 0.5, max_interval: float = 8.0,
+                 target_load: float = 0.7, window_sec: float = 10.0, min_window_sec: float = 4.0,
+                 min_new_sec: float = 0.5, alpha: float = 0.3):
+        self.target = target_sec
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_load = target_load
+        self.max_window = window_sec
+        self.min_window = min(min_window_sec, window_sec)
+        self.min_new = min_new_sec
+        self.alpha = alpha
+        self.decode_sec = None  # moving average of decode latency, queue wait included
+
+    def observe(self, decode_sec: float):
+        if self.decode_sec is None:
+            self.decode_sec = decode_sec
+        else:
+            self.decode_sec += self.alpha * (decode_sec - self.decode_sec)
+
+    def interval(self, load: float, degraded: bool = False) -> float:
+        decode = self.decode_sec or 0.0
+        interval = max(self.target - decode, decode) * load / self.target_load
+        if degraded:
+            # Lagging sessions are decoded half as often, which halves their share of the workers
+            interval *= 2
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def window(self, load: float) -> float:
+        return max(self.min_window, self.max_window / max(1.0, load / self.target_load))
+
+    def due(self, last_emit: float, now: float, new_sec: float, load: float, degraded: bool = False) -> bool:
+        """True if enough new audio has waited long enough to be worth a decode."""
+        return new_sec >= self.min_new and now - last_emit >= self.interval(load, degraded)
+
+    def wait(self, last_emit: float, now: float, new_sec: float, load: float, degraded: bool = False):
+        """Seconds until the next decode is due, or None if it waits for more audio."""
+        if new_sec < self.min_new:
+            return None
+        return max(0.0, last_emit + self.interval(load, degraded) - now)
+
+
+class WordTimeline:
+    """Session-wide word list that successive window decodes revise.
+
+    Words are (start, end, text, probability) tuples with absolute session
+    times. A decode of the window starting at ``cut`` seconds replaces every
+    word from ``cut`` on. Words before it are final: later windows may
+    reach back over them (the window grows as load drops), but anything
+    they decode there is ignored. Clients keep their own copy and apply
+    splices: ``update`` returns the index of the first word that changed
+    and the words from there on. A tick therefore costs the revised tail,
+    not the whole window.
+    """
+
+    def __init__(self, tolerance_sec: float = 0.2):
+        self.tolerance = tolerance_sec
+        self.words = []   # words that may still change
+        self.base = 0     # session index of words[0]; everything before it is final
+        self.final_end = 0.0  # end time of the last final word
+
+    def update(self, words: list, cut: float):
+        """Merge a decode of the window starting at cut; returns (newly final words, splice or None)."""
+        n_final = 0
+        while n_final < len(self.words) and self.words[n_final][0] < cut:
+            n_final += 1
+        final, old = self.words[:n_final], self.words[n_final:]
+        if final:
+            self.final_end = final[-1][1]
+        # Final words are never sent again: a window can start before them (it grew, or a
+        # word was cut in two by its start, which an earlier window decoded whole)
+        words = [w for w in words if w[0] >= self.final_end - 0.05]
+        same = 0
+        while same < min(len(old), len(words)) and self._same(old[same], words[same]):
+            same += 1
+        self.base += n_final
+        # Unchanged words keep the timing the client already has
+        self.words = old[:same] + words[same:]
+        if not final and same == len(old) == len(words):
+            return final, None
+        return final, {
+            "type": "words",
+            "index": self.base + same,
+            "final": self.base,
+            "words": [self._json(w) for w in words[same:]],
+        }
+
+    def finish(self) -> list:
+        """Everything not yet final, now final (end of stream)."""
+        final, self.words = self.words, []
+        self.base += len(final)
+        if final:
+            self.final_end = final[-1][1]
+        return final
+
+    def _same(self, a: tuple, b: tuple) -> bool:
+        return _norm(a[2]) == _norm(b[2]) and abs(a[0] - b[0]) <= self.tolerance
+
+    @staticmethod
+    def _json(word: tuple) -> dict:
+        return {"word": word[2].strip(), "start": round(word[0], 2), "end": round(word[1], 2), "p": round(word[3], 3)}